@@ -64,7 +64,7 @@ setup(
         # eg: 'keyword1', 'keyword2', 'keyword3',
     ],
     python_requires=">=3.6",
-    install_requires=["click", "dipy", "pybids"],
+    install_requires=["click", "dipy", "pyarrow", "pybids"],
     extras_require={
         "dev": ["pre-commit"],
         "test": ["pytest", "tox"],
@@ -1,6 +1,161 @@
+import re
+from functools import lru_cache
 from pathlib import Path
+from typing import Tuple, Union
+
+import bids
 
 BIDS_CONFIGURATION_FILE = (
     Path(__file__).parent / "derivatives.json"
 ).absolute()
+
+#: Entities' placeholders within path patterns (same syntax as pybids'),
+#: matched as ASCII since BIDS entities' names are ASCII-only
+PATTERN_ENTITY = re.compile(
+    r"{([\w\d]*?)(?:<[^>]+>)?(?:\|(?:\.?[\w])+)?\}", re.ASCII
+)
+
+
+#: pybids' configurations whose entities are parsed from file names
+PARSED_CONFIGURATIONS = ("bids", "derivatives")
+
+
+@lru_cache(maxsize=1)
+def _get_parsed_entities() -> tuple:
+    entities = {}
+    for configuration in PARSED_CONFIGURATIONS:
+        entities.update(bids.layout.models.Config.load(configuration).entities)
+    return tuple(entities.values())
+
+
+@lru_cache(maxsize=4096)
+def _parse_file_entities(source: str) -> dict:
+    return bids.layout.parse_file_entities(
+        source, entities=_get_parsed_entities()
+    )
+
+
+def parse_file_entities(source: Union[str, Path]) -> dict:
+    """
+    Parse a BIDS-compatible file name to its entities, memoized on the
+    string path. pybids' configurations are loaded once (rather than on
+    every call) and their entities passed to its parser as are.
+
+    Parameters
+    ----------
+    source : Union[str, Path]
+        Path to a BIDS-compatible file
+
+    Returns
+    -------
+    dict
+        A new dictionary of *source*'s entities, safe to modify in-place
+    """
+    return dict(_parse_file_entities(str(source)))
+
+
+def freeze_query(query: dict) -> frozenset:
+    """
+    Convert a bids query to a hashable key, to be used for memoization.
+
+    Parameters
+    ----------
+    query : dict
+        A bids query (entities as keys)
+
+    Returns
+    -------
+    frozenset
+        A frozenset of the query's items, with list values converted to tuples
+    """
+    return frozenset(
+        (key, tuple(value) if isinstance(value, list) else value)
+        for key, value in query.items()
+    )
+
+
+def compile_path_patterns(path_patterns: list) -> Tuple[tuple]:
+    """
+    Pre-parse *path_patterns* once into the set of entities each of them
+    defines.
+
+    Parameters
+    ----------
+    path_patterns : list
+        pybids-style path patterns
+
+    Returns
+    -------
+    Tuple[tuple]
+        Tuples of (pattern, frozenset of the pattern's entities)
+    """
+    return tuple(
+        (pattern, frozenset(PATTERN_ENTITY.findall(pattern)))
+        for pattern in path_patterns
+    )
+
+
+def match_path_patterns(entities: dict, compiled_patterns: tuple) -> list:
+    """
+    Select the patterns that may strictly match *entities*, so that pybids
+    only formats those, rather than every available pattern.
+
+    Parameters
+    ----------
+    entities : dict
+        BIDS entities of the path to be built
+    compiled_patterns : tuple
+        Patterns, as returned by :func:`compile_path_patterns`
+
+    Returns
+    -------
+    list
+        Patterns that define all of *entities*' (non-empty) entities
+    """
+    # pybids drops None and empty-string values before matching
+    defined = {key for key, value in entities.items() if value or value == 0}
+    return [
+        pattern
+        for pattern, pattern_entities in compiled_patterns
+        if defined <= pattern_entities
+    ]
+
+
+def _normalize_entity(key: str, value):
+    if key == "extension" and isinstance(value, str):
+        return value.lstrip(".")
+    return value
+
+
+def match_entities(entities: dict, filters: dict) -> bool:
+    """
+    Check whether a file's *entities* match bids query *filters*, following
+    pybids' query semantics (None requires the entity to be undefined, and
+    lists match any of their values).
+
+    Parameters
+    ----------
+    entities : dict
+        A file's BIDS entities
+    filters : dict
+        A bids query (entities as keys)
+
+    Returns
+    -------
+    bool
+        Whether *entities* match all of *filters*
+    """
+    for key, value in filters.items():
+        if value is None:
+            if entities.get(key) is not None:
+                return False
+            continue
+        if not isinstance(value, (list, tuple)):
+            value = [value]
+        target = _normalize_entity(key, entities.get(key))
+        if target not in [_normalize_entity(key, val) for val in value]:
+            return False
+    return True
+
+
 # flake8: noqa: E501
@@ -1,6 +1,8 @@
 from pathlib import Path
-from typing import List, Union
+from typing import List, Tuple, Union
 
+from qsiprep_analyses.data.bids import freeze_query
+from qsiprep_analyses.utils.data_grabber import DataGrabber
 from qsiprep_analyses.utils.utils import (
     apply_bids_filters,
     collect_subjects,
@@ -9,13 +11,41 @@ from qsiprep_analyses.utils.utils import (
 
 
 class QsiprepManager:
+    #: Reference types' keys within queries
+    REFERENCE_QUERIES = {"anat": "anat_reference", "dwi": "dwi_reference"}
+
     def __init__(
         self,
-        base_dir: Path,
+        base_dir: Path = None,
         participant_labels: Union[str, list] = None,
+        data_grabber: DataGrabber = None,
     ) -> None:
-        self.data_grabber = validate_instantiation(self, base_dir)
+        self.data_grabber = validate_instantiation(
+            self, base_dir, data_grabber
+        )
         self.subjects = collect_subjects(self, participant_labels)
+        #: Sorted (immutable) participants' labels
+        self.participant_labels = tuple(sorted(self.subjects))
+        #: Memoized DWIs' inputs, by (participant, session, queries)
+        self._subject_dwis = {}
+
+    def query_layout(self, query: dict) -> Tuple[Path]:
+        """
+        Query *self.data_grabber*'s layout. Results are memoized by the
+        DataGrabber, as identical queries are repeated across sessions,
+        tensor types and the managers sharing it.
+
+        Parameters
+        ----------
+        query : dict
+            A bids query (entities as keys)
+
+        Returns
+        -------
+        Tuple[Path]
+            Paths to all files matching *query*
+        """
+        return self.data_grabber.query(query)
 
     def get_transforms(
         self,
@@ -43,8 +73,8 @@ class QsiprepManager:
 
             query = dict(subject=participant_label, **queries.get(transform))
             query = apply_bids_filters(query, bids_filters)
-            result = self.data_grabber.layout.get(**query)
-            transforms[transform] = Path(result[0].path) if result else None
+            result = self.query_layout(query)
+            transforms[transform] = result[0] if result else None
         return transforms
 
     def get_reference(
@@ -76,11 +106,11 @@ class QsiprepManager:
         """
         query = dict(
             subject=participant_label,
-            **queries.get(f"{reference_type}_reference"),
+            **queries.get(self.REFERENCE_QUERIES.get(reference_type)),
         )
         query = apply_bids_filters(query, bids_filters)
-        result = self.data_grabber.layout.get(**query)
-        return Path(result[0].path) if result else None
+        result = self.query_layout(query)
+        return result[0] if result else None
 
     def get_probseg(
         self,
@@ -112,15 +142,17 @@ class QsiprepManager:
             **queries.get("probseg"),
         )
         query = apply_bids_filters(query, bids_filters)
-        result = self.data_grabber.layout.get(**query)
-        return Path(result[0].path) if result else None
+        result = self.query_layout(query)
+        return result[0] if result else None
 
     def get_subject_dwi(
         self, participant_label: str, session: str = None, queries: dict = None
     ) -> List[dict]:
         """
         Locate subject's available preprocessed DWIs and their corresponding
-        gradients (.bvec and .bval).
+        gradients (.bvec and .bval). Memoized per query, as the same
+        session's inputs are requested across tensor types and managers'
+        methods (copies are returned, so callers may modify them).
 
         Parameters
         ----------
@@ -132,8 +164,8 @@ class QsiprepManager:
         Returns
         -------
         List[dict]
-            A list of dictionary with keys of ["dwi","bvec","bval"] for all
-            available DWIs
+            A list of dictionary with keys of ["dwi","bvec","bval","mask"]
+            (and values of their paths, as strings) for all available DWIs
         """
         query = dict(
             subject=participant_label,
@@ -141,17 +173,35 @@ class QsiprepManager:
         )
         if session:
             query["session"] = session
-        dwi_files = self.data_grabber.layout.get(**query, return_type="file")
-        result = []
-        for dwi in dwi_files:
-            result.append(
+        key = freeze_query(query)
+        if key not in self._subject_dwis:
+            self._subject_dwis[key] = [
                 {
                     "dwi": dwi,
-                    "bval": self.data_grabber.layout.get_bval(dwi),
-                    "bvec": self.data_grabber.layout.get_bvec(dwi),
-                    "mask": self.data_grabber.build_path(
-                        dwi, {"desc": "brain", "suffix": "mask"}
+                    **self.get_gradients(dwi),
+                    "mask": str(
+                        self.data_grabber.build_path(
+                            dwi, {"desc": "brain", "suffix": "mask"}
+                        )
                     ),
                 }
-            )
-        return result
+                for dwi in map(str, self.query_layout(query))
+            ]
+        return [dict(inputs) for inputs in self._subject_dwis[key]]
+
+    def get_gradients(self, dwi: str) -> dict:
+        """
+        Locate a DWI's gradients (.bval and .bvec). Results are memoized by
+        the DataGrabber.
+
+        Parameters
+        ----------
+        dwi : str
+            Path to a preprocessed DWI
+
+        Returns
+        -------
+        dict
+            A dictionary with keys of ["bval","bvec"]
+        """
+        return self.data_grabber.get_gradients(dwi)
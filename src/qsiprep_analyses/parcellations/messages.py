@@ -0,0 +1,4 @@
+#: Errors
+INVALID_SCHEDULER = "Invalid scheduler ({scheduler}), available schedulers are: {available_schedulers}."  # noqa: E501
+MISSING_DASK = "Running with scheduler='dask' requires the optional dask package (pip install dask[delayed])."  # noqa: E501
+MISSING_TENSORS = "Could not find subject {participant_label}'s {tensor_type} outputs for session(s) {sessions} (see any warning of its failed fittings)."  # noqa: E501
@@ -1,34 +1,115 @@
 """
 Definition of the :class:`NativeParcellation` class.
 """
+import os
 import warnings
+from concurrent.futures import (
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+)
 from pathlib import Path
 from typing import Callable, Union
 
 import numpy as np
 import pandas as pd
+import pyarrow.dataset as ds
 from brain_parts.parcellation.parcellations import (
     Parcellation as parcellation_manager,
 )
 from tqdm import tqdm
 
 from qsiprep_analyses.manager import QsiprepManager
+from qsiprep_analyses.parcellations.messages import (
+    INVALID_SCHEDULER,
+    MISSING_DASK,
+    MISSING_TENSORS,
+)
+from qsiprep_analyses.parcellations.utils import (
+    ATLAS_PARCELS_KEY,
+    TABLE_EXTENSION,
+    VECTORIZED_MEASURES,
+    align_to_atlas,
+    load_label_index,
+    open_dataset,
+    read_table,
+    reduce_by_label,
+    write_subject_table,
+    write_table,
+)
 from qsiprep_analyses.registrations.registrations import NativeRegistration
 from qsiprep_analyses.tensors.tensor_estimation_mrtrix import TensorEstimation
+from qsiprep_analyses.utils.data_grabber import DataGrabber
+from qsiprep_analyses.utils.io import load_volume, prefetch_volumes
+from qsiprep_analyses.utils.utils import iterate_completed
+
+
+def _collect_subject(
+    data: pd.DataFrame, participant_label: str, output_dir: Path = None
+) -> Union[pd.DataFrame, Path]:
+    """
+    Either return a subject's parcellated data or, where *output_dir* is
+    given, write it to the dataset-wide table and return its path instead.
+    """
+    if output_dir is None:
+        return data
+    if data.empty:
+        return None
+    return write_subject_table(data, output_dir, participant_label)
+
+
+def _parcellate_single_subject(
+    base_dir: Path,
+    participant_label: str,
+    output_dir: Path = None,
+    database_path: Path = None,
+    **kwargs,
+) -> Union[pd.DataFrame, Path]:
+    """
+    Picklable entry point for parcellating a single subject within a worker
+    (process, thread or dask task), which instantiates its own
+    (single-subject) *NativeParcellation*, loading the layout's index from
+    *database_path* where available.
+    """
+    parcellation = NativeParcellation(
+        participant_labels=participant_label,
+        data_grabber=DataGrabber.get_or_create(base_dir, database_path),
+    )
+    data = parcellation.parcellate_single_subject(
+        participant_label=participant_label, **kwargs
+    )
+    return _collect_subject(data, participant_label, output_dir)
 
 
 class NativeParcellation(QsiprepManager):
+    #: Levels of parcellated data's rows
+    ROWS_NAMES = ("subject", "session", "metric")
+
+    #: Maximal number of sessions to be parcellated concurrently
+    SESSION_WORKERS = 4
+
+    #: Executors used by *parcellate_dataset* for each local scheduler
+    EXECUTORS = {
+        "threads": ThreadPoolExecutor,
+        "processes": ProcessPoolExecutor,
+    }
+
     def __init__(
         self,
-        base_dir: Path,
+        base_dir: Path = None,
         participant_labels: Union[str, list] = None,
+        data_grabber: DataGrabber = None,
     ) -> None:
-        super().__init__(base_dir, participant_labels)
+        super().__init__(base_dir, participant_labels, data_grabber)
         self.registration_manager = NativeRegistration(
-            base_dir, participant_labels
+            participant_labels=participant_labels,
+            data_grabber=self.data_grabber,
         )
         self.parcellation_manager = parcellation_manager()
-        self.tensor_estimation = TensorEstimation(base_dir, participant_labels)
+        self.tensor_estimation = TensorEstimation(
+            participant_labels=participant_labels,
+            data_grabber=self.data_grabber,
+        )
 
     def generate_rows(
         self,
@@ -55,57 +136,95 @@ class NativeParcellation(QsiprepManager):
         if session:
             if isinstance(session, str):
                 sessions = [session]
-            elif isinstance(session, str):
-                sessions = session
+            elif isinstance(session, (list, tuple)):
+                sessions = list(session)
         else:
             sessions = self.subjects.get(participant_label)
         metrics = self.tensor_estimation.METRICS.get(tensor_type)
+        if len(sessions) == 1:
+            return pd.MultiIndex.from_tuples(
+                [
+                    (participant_label, sessions[0], metric)
+                    for metric in metrics
+                ],
+                names=self.ROWS_NAMES,
+            )
         return pd.MultiIndex.from_product(
-            [[participant_label], sessions, metrics]
+            [[participant_label], sessions, metrics], names=self.ROWS_NAMES
         )
 
-    def build_output_name(
+    def build_output_entities(
         self,
         parcellation_scheme: str,
         parcellation_type: str,
         tensor_type: str,
-        parcellation_image: Union[Path, str],
         measure: Callable = np.nanmean,
-    ) -> Path:
+    ) -> dict:
         """
-        Reconstruct output "table"'s path
+        Output "table"'s BIDS entities, which are shared by all of a tensor
+        type's sessions and may therefore be computed once per tensor type.
 
         Parameters
         ----------
         parcellation_scheme : str
             Parcellation scheme to parcellate by
         parcellation_type : str
-            Either "Whole_brain" or "gm_cropped"
+            Either "whole_brain" or "gm_cropped"
         tensor_type : str
             Tensor reconstruction method
-        parcellation_image : Union[Path, str]
-            Subject-specific parcellation image
         measure : Callable, optional
             Measure to parcellate by, by default np.nanmean
 
         Returns
         -------
-        Path
-            Path to output table.
+        dict
+            Replacement entities for the parcellation image's path
         """
-        measure = measure.__name__
         acquisition = self.tensor_estimation.TENSOR_TYPES.get(tensor_type).get(
             "acq"
         )
-        entities = {
+        parts = parcellation_type.split("_")
+        return {
             "atlas": parcellation_scheme,
             "suffix": "dseg",
             "acquisition": acquisition,
-            "extension": ".pickle",
-            "measure": measure,
+            "extension": TABLE_EXTENSION,
+            "measure": measure.__name__,
+            "desc": "".join([parts[0], parts[1].capitalize()]),
         }
-        parts = parcellation_type.split("_")
-        entities["desc"] = "".join([parts[0], parts[1].capitalize()])
+
+    def build_output_name(
+        self,
+        parcellation_scheme: str,
+        parcellation_type: str,
+        tensor_type: str,
+        parcellation_image: Union[Path, str, dict],
+        measure: Callable = np.nanmean,
+    ) -> Path:
+        """
+        Reconstruct output "table"'s path
+
+        Parameters
+        ----------
+        parcellation_scheme : str
+            Parcellation scheme to parcellate by
+        parcellation_type : str
+            Either "Whole_brain" or "gm_cropped"
+        tensor_type : str
+            Tensor reconstruction method
+        parcellation_image : Union[Path, str, dict]
+            Subject-specific parcellation image, or its BIDS entities
+        measure : Callable, optional
+            Measure to parcellate by, by default np.nanmean
+
+        Returns
+        -------
+        Path
+            Path to output table.
+        """
+        entities = self.build_output_entities(
+            parcellation_scheme, parcellation_type, tensor_type, measure
+        )
         return self.data_grabber.build_path(parcellation_image, entities)
 
     def parcellate_single_tensor(
@@ -145,49 +264,338 @@ class NativeParcellation(QsiprepManager):
             as index and (parcellation_scheme,label) as columns
         """
         rows = self.generate_rows(participant_label, session, tensor_type)
+        sessions = list(rows.levels[1])
+        output_files = self.get_expected_outputs(
+            parcellation_scheme,
+            parcellation_type,
+            tensor_type,
+            participant_label,
+            sessions,
+            measure,
+        )
+        missing = [
+            session
+            for session in sessions
+            if force
+            or not output_files.get(session)
+            or not output_files.get(session).exists()
+        ]
+        frames = {
+            session: read_table(output_files.get(session)).reindex(
+                rows[rows.get_level_values(1) == session]
+            )
+            for session in sessions
+            if session not in missing
+        }
+        if missing:
+            frames.update(
+                self.parcellate_sessions(
+                    parcellation_scheme,
+                    tensor_type,
+                    participant_label,
+                    parcellation_type,
+                    rows,
+                    missing,
+                    measure,
+                    force,
+                    output_files,
+                )
+            )
+        return pd.concat(
+            [frames.get(session) for session in sessions]
+        ).reindex(rows)
+
+    def get_expected_outputs(
+        self,
+        parcellation_scheme: str,
+        parcellation_type: str,
+        tensor_type: str,
+        participant_label: str,
+        sessions: list,
+        measure: Callable = np.nanmean,
+    ) -> dict:
+        """
+        Reconstruct output "tables"' paths for *sessions* from BIDS entities
+        alone, without registering parcellations or estimating tensors.
+
+        Parameters
+        ----------
+        parcellation_scheme : str
+            Parcellation scheme to parcellate by
+        parcellation_type : str
+            Either "whole_brain" or "gm_cropped"
+        tensor_type : str
+            Tensor reconstruction method
+        participant_label : str
+            Specific participant's label
+        sessions : list
+            Specific sessions' labels
+        measure : Callable, optional
+            Measure to parcellate by, by default np.nanmean
+
+        Returns
+        -------
+        dict
+            A dictionary with sessions as keys and paths to output tables as
+            values (None where no DWI reference could be located)
+        """
+        entities = self.build_output_entities(
+            parcellation_scheme, parcellation_type, tensor_type, measure
+        )
+        outputs = {}
+        for session in sessions:
+            reference = self.registration_manager.get_reference(
+                participant_label,
+                "dwi",
+                {"session": session},
+                queries=self.registration_manager.QUERIES,
+            )
+            if not reference:
+                outputs[session] = None
+                continue
+            parcellation = self.registration_manager.build_output_dictionary(
+                parcellation_scheme, reference, "dwi"
+            ).get(parcellation_type)
+            outputs[session] = self.data_grabber.build_path(
+                parcellation, entities
+            )
+        return outputs
+
+    def parcellate_sessions(
+        self,
+        parcellation_scheme: str,
+        tensor_type: str,
+        participant_label: str,
+        parcellation_type: str,
+        rows: pd.MultiIndex,
+        sessions: list,
+        measure: Callable = np.nanmean,
+        force: bool = False,
+        output_files: dict = None,
+    ) -> dict:
+        """
+        Estimate tensors, register parcellations and parcellate tensor-derived
+        metrics for specific *sessions*, saving each session's table.
+
+        Parameters
+        ----------
+        parcellation_scheme : str
+            Parcellation scheme to parcellate by
+        tensor_type : str
+            Tensor reconstruction method
+        participant_label : str
+            Specific participant's label
+        parcellation_type : str
+            Either "whole_brain" or "gm_cropped"
+        rows : pd.MultiIndex
+            Participant's rows, as generated by *self.generate_rows*
+        sessions : list
+            Specific sessions' labels
+        measure : Callable, optional
+            Measure for parcellation, by default np.nanmean
+        force : bool, optional
+            Whether to re-write existing files, by default False
+        output_files : dict, optional
+            Sessions' output tables, as returned by *get_expected_outputs*, by
+            default None (reconstructed per session)
+
+        Returns
+        -------
+        dict
+            A dictionary with sessions as keys and their parcellated data as
+            values
+
+        Raises
+        ------
+        FileNotFoundError
+            In case any of *sessions* has no (successfully fitted) tensor
+            outputs
+        """
+        # Subjects are already dispatched to workers (see
+        # *parcellate_dataset*), so their tensors are estimated serially
         tensors = self.tensor_estimation.run_single_subject(
-            participant_label, session, tensor_type
+            participant_label, sessions, tensor_type, n_jobs=1
         )
+        # Failed fittings are left out of *tensors*
+        missing = [
+            session
+            for session in sessions
+            if not tensors.get(session, {}).get(tensor_type)
+        ]
+        if missing:
+            raise FileNotFoundError(
+                MISSING_TENSORS.format(
+                    participant_label=participant_label,
+                    tensor_type=tensor_type,
+                    sessions=missing,
+                )
+            )
         parcellation_images = self.registration_manager.run_single_subject(
             parcellation_scheme,
             participant_label,
-            participant_label,
-            session,
+            sessions,
             force=force,
         )
-        data = pd.DataFrame(index=rows)
-        for session in rows.levels[1]:
-            parcellation = parcellation_images.get(session).get(
-                parcellation_type
-            )
-            output_file = self.build_output_name(
+        output_files = output_files or {}
+        n_workers = min(len(sessions), self.SESSION_WORKERS)
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            futures = {
+                executor.submit(
+                    self.parcellate_session,
+                    parcellation_scheme,
+                    tensor_type,
+                    participant_label,
+                    parcellation_type,
+                    session,
+                    parcellation_images.get(session).get(parcellation_type),
+                    tensors.get(session).get(tensor_type)[0],
+                    rows[rows.get_level_values(1) == session],
+                    measure,
+                    output_files.get(session),
+                ): session
+                for session in sessions
+            }
+            return {
+                futures[future]: future.result()
+                for future in as_completed(futures)
+            }
+
+    def parcellate_session(
+        self,
+        parcellation_scheme: str,
+        tensor_type: str,
+        participant_label: str,
+        parcellation_type: str,
+        session: str,
+        parcellation: Path,
+        metrics: dict,
+        session_rows: pd.MultiIndex,
+        measure: Callable = np.nanmean,
+        output_file: Path = None,
+    ) -> pd.DataFrame:
+        """
+        Parcellate a single session's tensor-derived metrics and save its
+        table.
+
+        Parameters
+        ----------
+        parcellation_scheme : str
+            Parcellation scheme to parcellate by
+        tensor_type : str
+            Tensor reconstruction method
+        participant_label : str
+            Specific participant's label
+        parcellation_type : str
+            Either "whole_brain" or "gm_cropped"
+        session : str
+            Specific session's label
+        parcellation : Path
+            Session's native parcellation image
+        metrics : dict
+            A dictionary with metrics as keys and their images as values
+        session_rows : pd.MultiIndex
+            Session's rows within participant's rows
+        measure : Callable, optional
+            Measure for parcellation, by default np.nanmean
+        output_file : Path, optional
+            Session's output table, by default None (reconstructed from
+            *parcellation*)
+
+        Returns
+        -------
+        pd.DataFrame
+            Session's parcellated data
+        """
+        output_file = output_file or self.build_output_name(
+            parcellation_scheme,
+            parcellation_type,
+            tensor_type,
+            parcellation,
+            measure,
+        )
+        images = {
+            metric_image: metric for metric, metric_image in metrics.items()
+        }
+        if measure in VECTORIZED_MEASURES.values():
+            volumes = prefetch_volumes(images)
+        else:
+            volumes = ((metric_image, None) for metric_image in images)
+        records = {}
+        for metric_image, metric_data in volumes:
+            key = images.get(metric_image).split("_")[-1]
+
+            tmp_data = self.parcellate_image(
                 parcellation_scheme,
-                parcellation_type,
-                tensor_type,
                 parcellation,
-                measure,
+                metric_image,
+                key,
+                measure=measure,
+                metric_data=metric_data,
             )
-            if output_file.exists() and not force:
-                return pd.read_pickle(output_file)
-            for metric, metric_image in (
-                tensors.get(session).get(tensor_type)[0].items()
-            ):
-                key = metric.split("_")[-1]
-
-                tmp_data = self.parcellation_manager.parcellate_image(
-                    parcellation_scheme,
-                    parcellation,
-                    metric_image,
-                    key,
-                    measure=measure,
-                )
-                data.loc[
-                    (participant_label, session, key),
-                    tmp_data.index,
-                ] = tmp_data.loc[tmp_data.index]
-            data.to_pickle(output_file)
+            records[(participant_label, session, key)] = tmp_data
+        if records:
+            data = pd.DataFrame(
+                list(records.values()),
+                index=pd.MultiIndex.from_tuples(list(records)),
+            ).reindex(session_rows)
+        else:
+            data = pd.DataFrame(index=session_rows)
+        write_table(data, output_file)
         return data
 
+    def parcellate_image(
+        self,
+        parcellation_scheme: str,
+        parcellation_image: Union[Path, str],
+        metric_image: Union[Path, str],
+        metric_name: str,
+        measure: Callable = np.nanmean,
+        metric_data: np.ndarray = None,
+    ) -> pd.Series:
+        """
+        Parcellate a single metric image. Measures listed in
+        *VECTORIZED_MEASURES* are reduced over all labels at once (and indexed
+        by the atlas' full label table, as delegated measures are), while any
+        other measure is delegated to *self.parcellation_manager*.
+
+        Parameters
+        ----------
+        parcellation_scheme : str
+            Parcellation scheme to parcellate by
+        parcellation_image : Union[Path, str]
+            Subject-specific parcellation image
+        metric_image : Union[Path, str]
+            Tensor-derived metric image
+        metric_name : str
+            Metric's name
+        measure : Callable, optional
+            Measure to parcellate by, by default np.nanmean
+        metric_data : np.ndarray, optional
+            *metric_image*'s already loaded data, by default None
+
+        Returns
+        -------
+        pd.Series
+            Parcellated metric, with parcellation's labels as index
+        """
+        if measure not in VECTORIZED_MEASURES.values():
+            return self.parcellation_manager.parcellate_image(
+                parcellation_scheme,
+                parcellation_image,
+                metric_image,
+                metric_name,
+                measure=measure,
+            )
+        if metric_data is None:
+            metric_data, _ = load_volume(metric_image)
+        unique, values = reduce_by_label(
+            metric_data, load_label_index(parcellation_image), measure
+        )
+        parcels = self.parcellation_manager.parcellations.get(
+            parcellation_scheme
+        ).get(ATLAS_PARCELS_KEY)
+        return align_to_atlas(unique, values, parcels, name=metric_name)
+
     def parcellate_single_subject(
         self,
         parcellation_scheme: str,
@@ -220,7 +628,7 @@ class NativeParcellation(QsiprepManager):
         pd.DataFrame
             All subject's availble parcellated data
         """
-        data = pd.DataFrame()
+        frames = []
         for tensor_type in self.tensor_estimation.TENSOR_TYPES:
             try:
                 tensor_data = self.parcellate_single_tensor(
@@ -232,13 +640,12 @@ class NativeParcellation(QsiprepManager):
                     measure,
                     force,
                 )
-                tensor_data = pd.concat([tensor_data], keys=[tensor_type])
-                data = pd.concat([data, tensor_data])
+                frames.append(pd.concat([tensor_data], keys=[tensor_type]))
             except (TypeError, FileNotFoundError):
                 warnings.warn(
                     f"Encountered an error when trying to parcellate subject {participant_label}'s data..."  # noqa
                 )
-        return data
+        return pd.concat(frames) if frames else pd.DataFrame()
 
     def parcellate_dataset(
         self,
@@ -246,20 +653,157 @@ class NativeParcellation(QsiprepManager):
         parcellation_type: str = "whole_brain",
         measure: Callable = np.nanmean,
         force: bool = False,
-    ):
-        data = pd.DataFrame()
-        for participant_label in tqdm(self.subjects):
-            data = pd.concat(
-                [
-                    data,
+        n_jobs: int = None,
+        scheduler: str = "sync",
+        output_dir: Union[Path, str] = None,
+    ) -> Union[pd.DataFrame, ds.Dataset]:
+        """
+        Parcellate all available subjects, serially or in parallel across
+        subjects (see *scheduler*).
+
+        Parameters
+        ----------
+        parcellation_scheme : str
+            Parcellation scheme to parcellate by
+        parcellation_type : str, optional
+            Either "whole_brain" or "gm_cropped", by default "whole_brain"
+        measure : Callable, optional
+            Measure to parcellate by, by default np.nanmean
+        force : bool, optional
+            Whether to re-write existing files, by default False
+        n_jobs : int, optional
+            Number of local workers (with the "threads" and "processes"
+            schedulers), by default half of available CPUs
+        scheduler : str, optional
+            One of "sync", "threads", "processes" or "dask", by default
+            "sync". With "processes", *measure* must be picklable, and each
+            worker re-indexes the dataset unless the data grabber persists
+            its index (see *DataGrabber.database_path*). With "dask",
+            subjects are submitted as *dask.delayed* tasks to the active
+            scheduler, so an existing *dask.distributed.Client* (e.g.
+            connected to a *dask_jobqueue.SLURMCluster*) is used as is.
+        output_dir : Union[Path, str], optional
+            Where given, each subject's data is written (as soon as it is
+            parcellated) to a subject-partitioned Parquet dataset under
+            *output_dir*, instead of being gathered in memory, by default
+            None
+
+        Returns
+        -------
+        Union[pd.DataFrame, ds.Dataset]
+            All subjects' parcellated data, or a (lazy) Arrow dataset over it
+            where *output_dir* is given
+        """
+        kwargs = dict(
+            parcellation_scheme=parcellation_scheme,
+            parcellation_type=parcellation_type,
+            measure=measure,
+            force=force,
+        )
+        n_jobs = n_jobs or max(1, (os.cpu_count() or 1) // 2)
+        if scheduler == "sync" or (
+            scheduler in self.EXECUTORS and n_jobs == 1
+        ):
+            results = {
+                participant_label: _collect_subject(
                     self.parcellate_single_subject(
-                        parcellation_scheme,
-                        participant_label,
-                        parcellation_type,
-                        measure=measure,
-                        force=force,
+                        participant_label=participant_label, **kwargs
                     ),
-                ]
+                    participant_label,
+                    output_dir,
+                )
+                for participant_label in tqdm(self.participant_labels)
+            }
+        elif scheduler in self.EXECUTORS:
+            results = self.submit_subjects(
+                self.EXECUTORS.get(scheduler), n_jobs, output_dir, **kwargs
+            )
+        elif scheduler == "dask":
+            results = self.compute_subjects(output_dir, **kwargs)
+        else:
+            raise ValueError(
+                INVALID_SCHEDULER.format(
+                    scheduler=scheduler,
+                    available_schedulers=["sync", "dask", *self.EXECUTORS],
+                )
             )
+        if output_dir is not None:
+            return open_dataset(output_dir)
+        frames = [results.get(label) for label in self.participant_labels]
+        return pd.concat(frames) if frames else pd.DataFrame()
 
-        return data
+    def submit_subjects(
+        self,
+        executor_class: type,
+        n_jobs: int,
+        output_dir: Union[Path, str] = None,
+        **kwargs,
+    ) -> dict:
+        """
+        Parcellate all available subjects on a local executor.
+
+        Parameters
+        ----------
+        executor_class : type
+            Either *ThreadPoolExecutor* or *ProcessPoolExecutor*
+        n_jobs : int
+            Number of workers
+        output_dir : Union[Path, str], optional
+            Where given, workers write their subject's data under it, by
+            default None
+
+        Returns
+        -------
+        dict
+            Parcellated data (or paths to it) keyed by participant label
+        """
+        results = {}
+        with executor_class(max_workers=n_jobs) as executor:
+            futures = {
+                executor.submit(
+                    _parcellate_single_subject,
+                    self.data_grabber.base_dir,
+                    participant_label,
+                    output_dir,
+                    self.data_grabber.database_path,
+                    **kwargs,
+                ): participant_label
+                for participant_label in self.participant_labels
+            }
+            for future in iterate_completed(futures):
+                results[futures[future]] = future.result()
+        return results
+
+    def compute_subjects(
+        self, output_dir: Union[Path, str] = None, **kwargs
+    ) -> dict:
+        """
+        Parcellate all available subjects as a graph of *dask.delayed* tasks.
+
+        Parameters
+        ----------
+        output_dir : Union[Path, str], optional
+            Where given, tasks write their subject's data under it, by
+            default None
+
+        Returns
+        -------
+        dict
+            Parcellated data (or paths to it) keyed by participant label
+        """
+        try:
+            import dask
+        except ImportError as e:
+            raise ImportError(MISSING_DASK) from e
+        tasks = [
+            dask.delayed(_parcellate_single_subject)(
+                self.data_grabber.base_dir,
+                participant_label,
+                output_dir,
+                self.data_grabber.database_path,
+                **kwargs,
+            )
+            for participant_label in self.participant_labels
+        ]
+        frames = dask.compute(*tasks)
+        return dict(zip(self.participant_labels, frames))
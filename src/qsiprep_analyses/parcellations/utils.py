@@ -0,0 +1,265 @@
+import os
+from functools import lru_cache
+from pathlib import Path
+from types import MappingProxyType
+from typing import Callable, Tuple, Union
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+from qsiprep_analyses.utils.io import load_labels
+
+#: Measures that can be reduced over all labels at once, identified by the
+#: functions themselves (rather than by their, possibly shared, names)
+VECTORIZED_MEASURES = MappingProxyType(
+    dict(nanmean=np.nanmean, nansum=np.nansum, nanstd=np.nanstd)
+)
+
+#: Atlases' label tables within *brain_parts*' parcellations
+ATLAS_PARCELS_KEY = "parcels"
+ATLAS_LABEL_COLUMN = "Label"
+
+#: Background label, excluded from parcellation
+BACKGROUND_LABEL = 0
+
+#: Parcellated tables' format
+TABLE_EXTENSION = ".parquet"
+TABLE_COMPRESSION = "zstd"
+COLUMNS_SEPARATOR = "__"
+
+#: Partitioning of dataset-wide parcellated tables (one directory per subject)
+SUBJECT_PARTITIONING = ds.partitioning(
+    pa.schema([("subject", pa.string())]), flavor="hive"
+)
+
+
+def index_labels(labels: np.ndarray) -> Tuple[np.ndarray]:
+    """
+    Factorize a parcellation image's labels, once for all metrics to be
+    parcellated by it.
+
+    Parameters
+    ----------
+    labels : np.ndarray
+        An integer parcellation image
+
+    Returns
+    -------
+    Tuple[np.ndarray]
+        The (sorted) labels found within *labels*, each parcellated voxel's
+        position within them and a (flat) mask of parcellated voxels
+    """
+    labels = np.ravel(labels)
+    in_parcellation = labels != BACKGROUND_LABEL
+    unique, inverse = np.unique(labels[in_parcellation], return_inverse=True)
+    return unique, inverse.ravel(), in_parcellation
+
+
+@lru_cache(maxsize=8)
+def _load_label_index(path: str, mtime: int, size: int) -> Tuple[np.ndarray]:
+    labels, _ = load_labels(path)
+    return index_labels(labels)
+
+
+def load_label_index(path: Union[Path, str]) -> Tuple[np.ndarray]:
+    """
+    Load and factorize a parcellation image, memoized on the file's path,
+    modification time and size.
+
+    Parameters
+    ----------
+    path : Union[Path, str]
+        Path to a parcellation image
+
+    Returns
+    -------
+    Tuple[np.ndarray]
+        The parcellation's labels' index, as returned by :func:`index_labels`
+    """
+    stat = os.stat(path)
+    return _load_label_index(str(path), stat.st_mtime_ns, stat.st_size)
+
+
+def reduce_by_label(
+    data: np.ndarray,
+    label_index: Tuple[np.ndarray],
+    measure: Callable = np.nanmean,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Reduce *data* within each label's region in a single pass over
+    the volume (rather than masking the volume once per label).
+
+    Parameters
+    ----------
+    data : np.ndarray
+        A metric's image data
+    label_index : Tuple[np.ndarray]
+        The parcellation's labels' index, as returned by :func:`index_labels`
+    measure : Callable, optional
+        One of *VECTORIZED_MEASURES*, by default np.nanmean
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        The (sorted) labels of the parcellation and their reduced values
+    """
+    unique, inverse, in_parcellation = label_index
+    data = np.ravel(data)[in_parcellation]
+    valid = ~np.isnan(data)
+    inverse, data = inverse[valid], data[valid]
+    sums = np.bincount(inverse, weights=data, minlength=unique.size)
+    if measure is np.nansum:
+        return unique, sums
+    counts = np.bincount(inverse, minlength=unique.size)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = sums / counts
+        if measure is np.nanmean:
+            return unique, means
+        squares = np.bincount(
+            inverse,
+            weights=(data - means[inverse]) ** 2,
+            minlength=unique.size,
+        )
+        return unique, np.sqrt(squares / counts)
+
+
+def align_to_atlas(
+    unique: np.ndarray,
+    values: np.ndarray,
+    parcels: pd.DataFrame,
+    name: str = None,
+) -> pd.Series:
+    """
+    Index reduced values (see :func:`reduce_by_label`) by an atlas' full
+    label table, so that parcels missing from a subject's parcellation are
+    kept (as NaN).
+
+    Parameters
+    ----------
+    unique : np.ndarray
+        The labels found within the subject's parcellation
+    values : np.ndarray
+        Their reduced values
+    parcels : pd.DataFrame
+        The atlas' label table, with labels' values in *ATLAS_LABEL_COLUMN*
+    name : str, optional
+        The resulting series' name, by default None
+
+    Returns
+    -------
+    pd.Series
+        Reduced values, indexed as *parcels*
+    """
+    reduced = pd.Series(values, index=unique)
+    labels = parcels[ATLAS_LABEL_COLUMN].to_numpy()
+    return pd.Series(
+        reduced.reindex(labels).to_numpy(), index=parcels.index, name=name
+    )
+
+
+def _restore_label(label: str) -> Union[int, str]:
+    return int(label) if label.lstrip("-").isdigit() else label
+
+
+def write_table(data: pd.DataFrame, path: Union[Path, str]) -> None:
+    """
+    Write a parcellated table as (columnar, compressed) Parquet. Parquet
+    requires string column names, so labels are stringified and
+    multi-level columns are joined by *COLUMNS_SEPARATOR*.
+
+    Parameters
+    ----------
+    data : pd.DataFrame
+        Parcellated data
+    path : Union[Path, str]
+        Output path
+    """
+    data = data.copy(deep=False)
+    data.columns = [
+        COLUMNS_SEPARATOR.join(str(level) for level in column)
+        if isinstance(column, tuple)
+        else str(column)
+        for column in data.columns
+    ]
+    data.to_parquet(path, engine="pyarrow", compression=TABLE_COMPRESSION)
+
+
+def read_table(path: Union[Path, str]) -> pd.DataFrame:
+    """
+    Read a parcellated table written by :func:`write_table`, restoring its
+    columns' labels.
+
+    Parameters
+    ----------
+    path : Union[Path, str]
+        Path to a parcellated table
+
+    Returns
+    -------
+    pd.DataFrame
+        Parcellated data
+    """
+    data = pd.read_parquet(path, engine="pyarrow", memory_map=True)
+    columns = [
+        tuple(
+            _restore_label(level) for level in column.split(COLUMNS_SEPARATOR)
+        )
+        for column in data.columns
+    ]
+    if any(len(column) > 1 for column in columns):
+        data.columns = pd.MultiIndex.from_tuples(columns)
+    else:
+        data.columns = [column[0] for column in columns]
+    return data
+
+
+def write_subject_table(
+    data: pd.DataFrame, output_dir: Union[Path, str], participant_label: str
+) -> Path:
+    """
+    Write a single subject's parcellated data as its own partition of a
+    dataset-wide Parquet dataset. The "subject" level is dropped from the
+    rows, as it is recovered from the partition itself.
+
+    Parameters
+    ----------
+    data : pd.DataFrame
+        Subject's parcellated data
+    output_dir : Union[Path, str]
+        Dataset's root directory
+    participant_label : str
+        Specific participant's label
+
+    Returns
+    -------
+    Path
+        Path to the subject's table
+    """
+    partition = Path(output_dir) / f"subject={participant_label}"
+    partition.mkdir(parents=True, exist_ok=True)
+    path = partition / f"sub-{participant_label}{TABLE_EXTENSION}"
+    if "subject" in data.index.names:
+        data = data.droplevel("subject")
+    write_table(data, path)
+    return path
+
+
+def open_dataset(output_dir: Union[Path, str]) -> ds.Dataset:
+    """
+    Lazily open a dataset written by :func:`write_subject_table`.
+
+    Parameters
+    ----------
+    output_dir : Union[Path, str]
+        Dataset's root directory
+
+    Returns
+    -------
+    ds.Dataset
+        A (subject-partitioned) Arrow dataset
+    """
+    return ds.dataset(
+        output_dir, format="parquet", partitioning=SUBJECT_PARTITIONING
+    )
@@ -1,6 +1,8 @@
 """
 Definition of the :class:`NativeRegistration` class.
 """
+import os
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from typing import Tuple, Union
 
@@ -8,7 +10,6 @@ import nibabel as nib
 from brain_parts.parcellation.parcellations import (
     Parcellation as parcellation_manager,
 )
-from nilearn.image.resampling import resample_to_img
 from nipype.interfaces.base import TraitError
 from tqdm import tqdm
 
@@ -18,7 +19,41 @@ from qsiprep_analyses.registrations.utils import (
     PROBSEG_THRESHOLD,
     QUERIES,
     TRANSFORMS,
+    apply_coordinates_lut,
+    build_coordinates_lut,
+    crop_to_probseg,
 )
+from qsiprep_analyses.utils.data_grabber import DataGrabber
+from qsiprep_analyses.utils.io import load_labels, save_labels
+from qsiprep_analyses.utils.utils import iterate_completed
+
+
+def _run_single_subject(
+    base_dir: Path,
+    database_path: Path,
+    parcellation_scheme: str,
+    participant_label: str,
+    probseg_threshold: float = None,
+    force: bool = False,
+) -> dict:
+    """
+    Picklable entry point for registering a single subject within a worker
+    process, which instantiates its own DataGrabber and
+    *NativeRegistration* rather than inheriting live layout handles.
+    """
+    registration = NativeRegistration(
+        participant_labels=participant_label,
+        data_grabber=DataGrabber.get_or_create(base_dir, database_path),
+    )
+    try:
+        return registration.run_single_subject(
+            parcellation_scheme,
+            participant_label,
+            probseg_threshold=probseg_threshold,
+            force=force,
+        )
+    except (FileNotFoundError, TraitError):
+        return None
 
 
 class NativeRegistration(QsiprepManager):
@@ -35,10 +70,11 @@ class NativeRegistration(QsiprepManager):
 
     def __init__(
         self,
-        base_dir: Path,
+        base_dir: Path = None,
         participant_labels: Union[str, list] = None,
+        data_grabber: DataGrabber = None,
     ) -> None:
-        super().__init__(base_dir, participant_labels)
+        super().__init__(base_dir, participant_labels, data_grabber)
         self.parcellation_manager = parcellation_manager()
 
     def initiate_subject(
@@ -57,14 +93,17 @@ class NativeRegistration(QsiprepManager):
         Tuple[dict,Path,Path]
             A tuple of required files for parcellation registration.
         """
-        return [
+        # A single layout query indexes the participant's files, leaving the
+        # grabbers below to filter that (in-memory) index.
+        self.data_grabber.get_subject_files(participant_label)
+        return tuple(
             grabber(participant_label, queries=self.QUERIES)
             for grabber in [
                 self.get_transforms,
                 self.get_reference,
                 self.get_probseg,
             ]
-        ]
+        )
 
     def build_output_dictionary(
         self,
@@ -89,15 +128,14 @@ class NativeRegistration(QsiprepManager):
             A dictionary with keys of "whole-brain" and "gm-cropped" and their
             corresponding paths
         """
-        basic_query = dict(
-            atlas=parcellation_scheme,
-            resolution=reference_type,
-            **self.DEFAULT_PARCELLATION_NAMING.copy(),
-        )
         outputs = dict()
         for key, label in zip(["whole_brain", "gm_cropped"], ["", "GM"]):
-            query = basic_query.copy()
-            query["label"] = label
+            query = dict(
+                self.DEFAULT_PARCELLATION_NAMING,
+                atlas=parcellation_scheme,
+                resolution=reference_type,
+                label=label,
+            )
             outputs[key] = self.data_grabber.build_path(reference, query)
         return outputs
 
@@ -127,15 +165,22 @@ class NativeRegistration(QsiprepManager):
         dict
             A dictionary with keys of "whole_brain" and "gm_cropped" native-spaced parcellation schemes.
         """
+        reference = self.get_reference(
+            participant_label, "anat", queries=self.QUERIES
+        )
+        if not reference:
+            raise FileNotFoundError(
+                f"Could not find reference file for subject {participant_label}!"  # noqa
+            )
+        outputs = self.build_output_dictionary(
+            parcellation_scheme, reference, "anat"
+        )
+        whole_brain, gm_cropped = outputs["whole_brain"], outputs["gm_cropped"]
+        if not force and whole_brain.exists() and gm_cropped.exists():
+            return whole_brain, gm_cropped
         transforms, reference, gm_probseg = self.initiate_subject(
             participant_label
         )
-        whole_brain, gm_cropped = [
-            self.build_output_dictionary(
-                parcellation_scheme, reference, "anat"
-            ).get(key)
-            for key in ["whole_brain", "gm_cropped"]
-        ]
         self.parcellation_manager.register_parcellation_scheme(
             parcellation_scheme,
             participant_label,
@@ -144,9 +189,7 @@ class NativeRegistration(QsiprepManager):
             whole_brain,
             force=force,
         )
-        self.parcellation_manager.crop_to_probseg(
-            parcellation_scheme,
-            participant_label,
+        crop_to_probseg(
             whole_brain,
             gm_probseg,
             gm_cropped,
@@ -163,9 +206,12 @@ class NativeRegistration(QsiprepManager):
         anatomical_whole_brain: Path,
         anatomical_gm_cropped: Path,
         force: bool = False,
+        cache: dict = None,
     ):
         """
-        Resample parcellation scheme from anatomical to DWI space.
+        Resample parcellation scheme from anatomical to DWI space (nearest
+        neighbour). Both parcellations share the anatomical grid, so the
+        anatomical-to-DWI voxels' lookup table is computed once per grid.
 
         Parameters
         ----------
@@ -179,6 +225,10 @@ class NativeRegistration(QsiprepManager):
             Participant's GM-cropped parcellation scheme in anatomical space
         force : bool, optional
             Whether to re-write existing files, by default False
+        cache : dict, optional
+            Loaded anatomical parcellations (keyed by path) and lookup tables
+            (keyed by pair of grids), shared between a participant's
+            sessions, by default None
         """
         reference = self.get_reference(
             participant_label,
@@ -190,21 +240,34 @@ class NativeRegistration(QsiprepManager):
             raise FileNotFoundError(
                 f"Could not find reference file for subject {participant_label}!"  # noqa
             )
-        whole_brain, gm_cropped = [
-            self.build_output_dictionary(
-                parcellation_scheme, reference, "dwi"
-            ).get(key)
-            for key in ["whole_brain", "gm_cropped"]
-        ]
+        outputs = self.build_output_dictionary(
+            parcellation_scheme, reference, "dwi"
+        )
+        whole_brain, gm_cropped = outputs["whole_brain"], outputs["gm_cropped"]
+        if not force and whole_brain.exists() and gm_cropped.exists():
+            return whole_brain, gm_cropped
+        cache = {} if cache is None else cache
+        reference_img = nib.load(str(reference))
+        reference_grid = (reference_img.affine, reference_img.shape[:3])
         for source, target in zip(
             [anatomical_whole_brain, anatomical_gm_cropped],
             [whole_brain, gm_cropped],
         ):
             if not target.exists() or force:
-                img = resample_to_img(
-                    str(source), str(reference), interpolation="nearest"
+                if source not in cache:
+                    cache[source] = load_labels(source)
+                labels, affine = cache.get(source)
+                grids = (
+                    affine.tobytes(),
+                    reference_grid[0].tobytes(),
+                    reference_grid[1],
                 )
-                nib.save(img, target)
+                if grids not in cache:
+                    cache[grids] = build_coordinates_lut(
+                        affine, labels.shape, *reference_grid
+                    )
+                data = apply_coordinates_lut(labels, cache.get(grids))
+                save_labels(data, reference_img.affine, target)
 
         return whole_brain, gm_cropped
 
@@ -246,9 +309,11 @@ class NativeRegistration(QsiprepManager):
             "whole_brain": anat_whole_brain,
             "gm_cropped": anat_gm_cropped,
         }
-        sessions = self.subjects.get(participant_label) or session
+        sessions = session or self.subjects.get(participant_label)
         if isinstance(sessions, str):
             sessions = [sessions]
+        # Anatomical parcellations are read (at most) once for all sessions
+        cache = {}
         for session in sessions:
             whole_brain, gm_cropped = self.register_dwi(
                 parcellation_scheme,
@@ -257,6 +322,7 @@ class NativeRegistration(QsiprepManager):
                 anat_whole_brain,
                 anat_gm_cropped,
                 force,
+                cache,
             )
             outputs[session] = {
                 "whole_brain": whole_brain,
@@ -270,9 +336,11 @@ class NativeRegistration(QsiprepManager):
         participant_label: Union[str, list] = None,
         probseg_threshold: float = None,
         force: bool = False,
-    ):
+        n_jobs: int = None,
+    ) -> dict:
         """
-        Register *parcellation_scheme* to all available (or requested) subjects' native space.
+        Register *parcellation_scheme* to all available (or requested) subjects' native space,
+        in parallel across subjects.
 
         Parameters
         ----------
@@ -284,6 +352,13 @@ class NativeRegistration(QsiprepManager):
             Threshold for probability segmentation masking, by default None
         force : bool, optional
             Whether to remove existing products and generate new ones, by default False # noqa
+        n_jobs : int, optional
+            Number of worker processes, by default all available CPUs
+
+        Returns
+        -------
+        dict
+            A dictionary with participant labels as keys and their native parcellations as values
         """
         native_parcellations = {}
         if participant_label:
@@ -292,17 +367,39 @@ class NativeRegistration(QsiprepManager):
             elif isinstance(participant_label, list):
                 participant_labels = participant_label
         else:
-            participant_labels = list(sorted(self.subjects.keys()))
-        for participant_label in tqdm(participant_labels):
-            try:
-                native_parcellations[
-                    participant_label
-                ] = self.run_single_subject(
+            participant_labels = self.participant_labels
+        n_jobs = n_jobs or os.cpu_count() or 1
+        if n_jobs == 1:
+            for participant_label in tqdm(participant_labels):
+                try:
+                    native_parcellations[
+                        participant_label
+                    ] = self.run_single_subject(
+                        parcellation_scheme,
+                        participant_label,
+                        probseg_threshold=probseg_threshold,
+                        force=force,
+                    )
+                except (FileNotFoundError, TraitError):
+                    continue
+            return native_parcellations
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            futures = {
+                executor.submit(
+                    _run_single_subject,
+                    self.data_grabber.base_dir,
+                    self.data_grabber.database_path,
                     parcellation_scheme,
                     participant_label,
-                    probseg_threshold=probseg_threshold,
-                    force=force,
-                )
-            except (FileNotFoundError, TraitError):
-                continue
-        return native_parcellations
+                    probseg_threshold,
+                    force,
+                ): participant_label
+                for participant_label in participant_labels
+            }
+            for future in iterate_completed(futures):
+                native_parcellations[futures[future]] = future.result()
+        return {
+            participant_label: native_parcellations.get(participant_label)
+            for participant_label in participant_labels
+            if native_parcellations.get(participant_label) is not None
+        }
@@ -1,3 +1,11 @@
+from pathlib import Path
+from types import MappingProxyType
+from typing import Tuple, Union
+
+import numpy as np
+
+from qsiprep_analyses.utils.io import load_labels, load_volume, save_labels
+
 QUERIES = dict(
     mni2native={
         "from": "MNI152NLin2009cAsym",
@@ -27,12 +35,131 @@ QUERIES = dict(
     },
     probseg={"suffix": "probseg"},
 )
+#: Read-only views, as queries are shared between all instances
+QUERIES = MappingProxyType(
+    {key: MappingProxyType(query) for key, query in QUERIES.items()}
+)
 
 #: Naming
-DEFAULT_PARCELLATION_NAMING = dict(space="T1w", suffix="dseg", desc="")
+DEFAULT_PARCELLATION_NAMING = MappingProxyType(
+    dict(space="T1w", suffix="dseg", desc="")
+)
 
 #: Types of transformations
-TRANSFORMS = ["mni2native", "native2mni"]
+TRANSFORMS = ("mni2native", "native2mni")
 
 #: Default probability segmentations' threshold
 PROBSEG_THRESHOLD = 0.01
+
+
+def build_coordinates_lut(
+    source_affine: np.ndarray,
+    source_shape: Tuple[int],
+    reference_affine: np.ndarray,
+    reference_shape: Tuple[int],
+) -> np.ndarray:
+    """
+    Compute, once per source-to-reference pair of grids, the (nearest)
+    source voxel of each of the reference's voxels. The resulting lookup
+    table may be applied to any image sharing the source's grid with
+    :func:`apply_coordinates_lut`.
+
+    Parameters
+    ----------
+    source_affine : np.ndarray
+        Source image's affine
+    source_shape : Tuple[int]
+        Source image's (spatial) shape
+    reference_affine : np.ndarray
+        Reference image's affine
+    reference_shape : Tuple[int]
+        Reference image's (spatial) shape
+
+    Returns
+    -------
+    np.ndarray
+        A *reference_shape* array of flat indices into the source's voxels,
+        with the source's size marking voxels outside of its grid
+    """
+    source_shape = tuple(source_shape[:3])
+    transform = np.linalg.inv(source_affine) @ reference_affine
+    grid = np.indices(reference_shape, dtype=np.float32).reshape(3, -1)
+    coordinates = transform[:3, :3] @ grid + transform[:3, 3:]
+    bounds = np.asarray(source_shape).reshape(3, 1) - 1
+    outside = ((coordinates < 0) | (coordinates > bounds)).any(axis=0)
+    indices = np.floor(coordinates + 0.5).astype(np.int32)
+    indices[:, outside] = 0
+    lut = np.ravel_multi_index(indices, source_shape).astype(np.int32)
+    lut[outside] = np.prod(source_shape)
+    return lut.reshape(reference_shape)
+
+
+def apply_coordinates_lut(labels: np.ndarray, lut: np.ndarray) -> np.ndarray:
+    """
+    Resample *labels* by a single gather of their voxels, preserving their
+    (narrow) integer data type and without copying the source volume.
+
+    Parameters
+    ----------
+    labels : np.ndarray
+        A (3D) labels image on the lookup table's source grid
+    lut : np.ndarray
+        A lookup table, as returned by :func:`build_coordinates_lut`
+
+    Returns
+    -------
+    np.ndarray
+        *labels* resampled to the lookup table's reference grid (background
+        outside of the source's grid)
+    """
+    flat = labels.reshape(-1)
+    resampled = np.take(flat, lut, mode="clip")
+    resampled[lut == flat.size] = 0
+    return resampled
+
+
+def crop_to_probseg(
+    parcellation: Union[Path, str],
+    probseg: Union[Path, str],
+    out_file: Union[Path, str],
+    masking_threshold: float = PROBSEG_THRESHOLD,
+    force: bool = False,
+) -> Path:
+    """
+    Crop a (native) parcellation to voxels whose probability exceeds
+    *masking_threshold*, in memory and in the parcellation's own data type.
+
+    Parameters
+    ----------
+    parcellation : Union[Path, str]
+        Path to a parcellation image
+    probseg : Union[Path, str]
+        Path to a probability segmentation image
+    out_file : Union[Path, str]
+        Path to the cropped parcellation
+    masking_threshold : float, optional
+        Probability threshold, by default PROBSEG_THRESHOLD
+    force : bool, optional
+        Whether to re-write an existing *out_file*, by default False
+
+    Returns
+    -------
+    Path
+        Path to the cropped parcellation
+    """
+    out_file = Path(out_file)
+    if out_file.exists() and not force:
+        return out_file
+    labels, affine = load_labels(parcellation)
+    probabilities, probseg_affine = load_volume(probseg)
+    if probabilities.shape[:3] != labels.shape[:3] or not np.allclose(
+        probseg_affine, affine
+    ):
+        lut = build_coordinates_lut(
+            probseg_affine, probabilities.shape, affine, labels.shape[:3]
+        )
+        probabilities = apply_coordinates_lut(probabilities, lut)
+    cropped = np.where(probabilities > masking_threshold, labels, 0).astype(
+        labels.dtype, copy=False
+    )
+    return save_labels(cropped, affine, out_file)
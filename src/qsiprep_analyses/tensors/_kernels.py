@@ -0,0 +1,168 @@
+"""
+Kernels of tensor fitting and eigenvalue-derived tensor metrics, compiled
+with *numba* (or run on a GPU with *cupy*) where it is available.
+"""
+from functools import lru_cache
+from typing import Tuple
+
+import numpy as np
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+    prange = range
+
+try:
+    import cupy
+except ImportError:
+    cupy = None
+
+#: Metrics computed by :func:`compute_dti_metrics` (in order)
+DTI_SCALARS = ("fa", "md", "ad", "rd")
+
+
+def _compute_dti_metrics(evals, fa, md, ad, rd):
+    for i in prange(evals.shape[0]):
+        l1, l2, l3 = evals[i, 0], evals[i, 1], evals[i, 2]
+        md_i = (l1 + l2 + l3) / 3.0
+        num = (l1 - md_i) ** 2 + (l2 - md_i) ** 2 + (l3 - md_i) ** 2
+        den = l1 * l1 + l2 * l2 + l3 * l3
+        fa[i] = min(np.sqrt(1.5 * num / den), 1.0) if den > 0 else 0.0
+        md[i] = md_i
+        ad[i] = l1
+        rd[i] = 0.5 * (l2 + l3)
+
+
+def _solve_normal(normal, projection, out):
+    for i in prange(normal.shape[0]):
+        # Cholesky decomposition of the (symmetric, positive-definite)
+        # normal matrix, followed by forward and backward substitutions
+        lower = np.zeros_like(normal[i])
+        n = len(lower)
+        for j in range(n):
+            for k in range(j + 1):
+                total = normal[i, j, k] - np.dot(lower[j, :k], lower[k, :k])
+                if j == k:
+                    lower[j, j] = np.sqrt(total)
+                else:
+                    lower[j, k] = total / lower[k, k]
+        solution = projection[i].copy()
+        for j in range(n):
+            solution[j] -= np.dot(lower[j, :j], solution[:j])
+            solution[j] /= lower[j, j]
+        for j in range(n - 1, -1, -1):
+            for k in range(j + 1, n):
+                solution[j] -= lower[k, j] * solution[k]
+            solution[j] /= lower[j, j]
+        out[i] = solution
+
+
+if njit is not None:
+    _compute_dti_metrics = njit(parallel=True, fastmath=True, cache=True)(
+        _compute_dti_metrics
+    )
+    _solve_normal = njit(
+        parallel=True, fastmath=True, cache=True, error_model="numpy"
+    )(_solve_normal)
+
+
+def compute_dti_metrics(evals: np.ndarray) -> Tuple[np.ndarray, ...]:
+    """
+    Compute FA, MD, AD and RD of all voxels in a single pass.
+
+    Parameters
+    ----------
+    evals : np.ndarray
+        (N, 3) array of descending eigenvalues
+
+    Returns
+    -------
+    Tuple[np.ndarray, ...]
+        (N,) arrays of FA, MD, AD and RD
+    """
+    if njit is not None:
+        metrics = tuple(np.empty(len(evals), evals.dtype) for _ in DTI_SCALARS)
+        _compute_dti_metrics(np.ascontiguousarray(evals), *metrics)
+        return metrics
+    md = evals.mean(axis=-1)
+    num = np.square(evals - md[:, None]).sum(axis=-1)
+    den = np.square(evals).sum(axis=-1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        fa = np.sqrt(1.5 * num / den)
+    fa = np.clip(np.nan_to_num(fa), 0, 1)
+    return fa, md, evals[:, 0], 0.5 * (evals[:, 1] + evals[:, 2])
+
+
+@lru_cache(maxsize=1)
+def gpu_available() -> bool:
+    """
+    Check whether *cupy* is installed and a CUDA device is available to it.
+    """
+    if cupy is None:
+        return False
+    try:
+        return cupy.cuda.runtime.getDeviceCount() > 0
+    except cupy.cuda.runtime.CUDARuntimeError:
+        return False
+
+
+def _build_normal_equations(xp, log_signal, design, pinv):
+    # Weights are scaled per voxel (which leaves the solution unchanged) to
+    # keep their squares within range.
+    prediction = (log_signal @ pinv.T) @ design.T
+    weights = xp.exp(prediction - prediction.max(axis=-1, keepdims=True)) ** 2
+    outer = xp.einsum("gi,gj->gij", design, design).reshape(len(design), -1)
+    normal = (weights @ outer).reshape(-1, design.shape[1], design.shape[1])
+    return normal, (weights * log_signal) @ design
+
+
+def _fit_wls_gpu(log_signal, design, pinv):
+    arrays = (cupy.asarray(array) for array in (log_signal, design, pinv))
+    normal, projection = _build_normal_equations(cupy, *arrays)
+    solution = cupy.linalg.solve(normal, projection[..., None])[..., 0]
+    return cupy.asnumpy(solution)
+
+
+def fit_wls(
+    log_signal: np.ndarray,
+    design: np.ndarray,
+    pinv: np.ndarray,
+    use_gpu: bool = False,
+) -> np.ndarray:
+    """
+    Solve the weighted least-squares fit of all voxels' log-signal, weighted
+    by their OLS-predicted signal (as in dipy's WLS fits). All voxels' normal
+    matrices are accumulated by a single matrix product with the design's
+    per-gradient outer products, and solved by a batched GPU solver (where
+    *use_gpu* and a device is available), or by a (parallel) Cholesky kernel
+    where *numba* is available.
+
+    Parameters
+    ----------
+    log_signal : np.ndarray
+        (N, G) array of the log-signal of N voxels
+    design : np.ndarray
+        (G, C) design matrix
+    pinv : np.ndarray
+        (C, G) pseudo-inverse of *design*
+    use_gpu : bool, optional
+        Whether to solve on a (CUDA) GPU where available, by default False
+
+    Returns
+    -------
+    np.ndarray
+        (N, C) array of fitted coefficients
+    """
+    if use_gpu and gpu_available():
+        try:
+            return _fit_wls_gpu(log_signal, design, pinv)
+        except cupy.cuda.memory.OutOfMemoryError:
+            # Fall back to the CPU for this (cache-sized) chunk only
+            pass
+    normal, projection = _build_normal_equations(np, log_signal, design, pinv)
+    if njit is not None:
+        out = np.empty_like(projection)
+        _solve_normal(normal, projection, out)
+        return out
+    return np.linalg.solve(normal, projection[..., None])[..., 0]
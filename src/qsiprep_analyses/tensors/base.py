@@ -0,0 +1,674 @@
+"""
+Definition of the :class:`BaseTensorEstimation` class, sharing the queries,
+validations and dispatching of tensor estimation's backends.
+"""
+import multiprocessing
+import os
+import threading
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+from types import MappingProxyType
+from typing import List, Tuple, Type, Union
+
+from qsiprep_analyses.manager import QsiprepManager
+from qsiprep_analyses.tensors.messages import (
+    INVALID_OUTPUT,
+    INVALID_PARTICIPANT,
+    TENSOR_RECONSTRUCTION_NOT_IMPLEMENTED,
+)
+from qsiprep_analyses.tensors.utils import (
+    DWI_ENTITIES,
+    JOBS_PER_BATCH,
+    KWARGS_MAPPING,
+    TENSOR_DERIVED_ENTITIES,
+    TENSOR_DERIVED_METRICS,
+    TENSOR_DERIVED_METRICS_LISTINGS,
+    TENSOR_DERIVED_METRICS_SETS,
+    limit_blas_threads,
+)
+from qsiprep_analyses.utils.data_grabber import DataGrabber
+from qsiprep_analyses.utils.utils import iterate_completed
+
+
+@lru_cache(maxsize=None)
+def _warn_invalid_output(
+    output: str, tensor_type: str, available_metrics: str
+) -> None:
+    """
+    Warn of an invalid requested output once per process, rather than once
+    per DWI it is requested for.
+    """
+    warnings.warn(
+        INVALID_OUTPUT.format(
+            output=output,
+            tensor_type=tensor_type,
+            available_metrics=available_metrics,
+        )
+    )
+
+
+def _run_input_batch(
+    estimator: Type["BaseTensorEstimation"],
+    estimator_kwargs: dict,
+    base_dir: Path,
+    database_path: Path,
+    participant_labels: List[str],
+    batch: List[Tuple[dict, str]],
+    out_metrics: list = None,
+    force: bool = False,
+) -> List[dict]:
+    """
+    Picklable entry point for estimating a batch of (DWI, tensor type) pairs
+    within a worker process, sharing its manager and cached design matrices.
+    """
+    tensor_estimation = estimator(
+        participant_labels=participant_labels,
+        data_grabber=DataGrabber.get_or_create(base_dir, database_path),
+        **estimator_kwargs,
+    )
+    return [
+        tensor_estimation.run_single_input(
+            inputs, tensor_type, out_metrics, force
+        )
+        for inputs, tensor_type in batch
+    ]
+
+
+class BaseTensorEstimation(QsiprepManager):
+    #: Templates
+    DWI_QUERY_ENTITIES = DWI_ENTITIES
+    TENSOR_ENTITIES = TENSOR_DERIVED_ENTITIES
+    METRICS = TENSOR_DERIVED_METRICS
+    METRICS_SETS = TENSOR_DERIVED_METRICS_SETS
+    METRICS_LISTINGS = TENSOR_DERIVED_METRICS_LISTINGS
+
+    #: Tensor Workflows
+    TENSOR_FITTING_KWARGS = KWARGS_MAPPING
+    #: Tensor types (implemented by each backend)
+    TENSOR_TYPES = MappingProxyType({})
+
+    def __init__(
+        self,
+        base_dir: Path = None,
+        participant_labels: Union[str, list] = None,
+        data_grabber: DataGrabber = None,
+    ) -> None:
+        super().__init__(base_dir, participant_labels, data_grabber)
+        # Split tensor types' fitting kwargs from their naming entity once,
+        # rather than on each input's run
+        self._tensor_kwargs = {
+            tensor_type: {
+                key: value for key, value in definition.items() if key != "acq"
+            }
+            for tensor_type, definition in self.TENSOR_TYPES.items()
+        }
+        self._tensor_entities = {
+            tensor_type: MappingProxyType(
+                dict(acquisition=definition.get("acq"), **self.TENSOR_ENTITIES)
+            )
+            for tensor_type, definition in self.TENSOR_TYPES.items()
+        }
+        #: Memoized output dictionaries, by (source, tensor type, outputs)
+        self._output_dictionaries = {}
+
+    def get_estimator_kwargs(self) -> dict:
+        """
+        Keyword arguments (besides the participants' labels and data grabber)
+        rebuilding an equivalent estimator within worker processes.
+
+        Returns
+        -------
+        dict
+            Backend-specific kwargs of the estimator's initialization
+        """
+        return {}
+
+    def validate_tensor_type(self, tensor_type: str) -> None:
+        """
+        Validates *tensor_type* as an implemented tensor estimation protocol.
+
+        Parameters
+        ----------
+        tensor_type : str
+            The tensor estimation method (either "dt" or "dk")
+
+        Raises
+        ------
+        NotImplementedError
+            In case *tensor_type* is not an implemented key of recognized
+            tensor-estimation protocol
+        """
+        if tensor_type not in self.TENSOR_TYPES:
+            raise NotImplementedError(
+                TENSOR_RECONSTRUCTION_NOT_IMPLEMENTED.format(
+                    tensor_type=tensor_type
+                )
+            )
+        return self.TENSOR_TYPES.get(tensor_type)
+
+    def validate_requested_output(self, tensor_type: str, output: str) -> bool:
+        """
+        Validates a requested output to be a valid *tensor_type* derived metric
+
+        Parameters
+        ----------
+        tensor_type : str
+            The tensor estimation method (either "dt" or "dk")
+        output : str
+            The requested output
+
+        Returns
+        -------
+        bool
+            Whether the requested *output* is a valid output of *tensor_type*
+            derived metrics
+        """
+        if output in self.METRICS_SETS.get(tensor_type):
+            return True
+        else:
+            _warn_invalid_output(
+                output, tensor_type, self.METRICS_LISTINGS.get(tensor_type)
+            )
+            return False
+
+    def build_output_dictionary(
+        self, source: Path, tensor_type: str, outputs: List[str] = None
+    ) -> dict:
+        """
+        Based on a *source* DWI, reconstruct output names for tensor-derived
+        metric available under *tensor_type*. Memoized per (source, tensor
+        type, outputs), as the same outputs are checked on every (re)run.
+
+        Parameters
+        ----------
+        source : Path
+            The source DWI file.
+        tensor_type : str
+            The tensor estimation method (either "dt" or "dk")
+        outputs : list, optional
+            Requested tensor-derived outputs, by default All available
+
+        Returns
+        -------
+        dict
+            A dictionary with keys of available/requested outputs and their
+            corresponding paths
+        """
+        key = (str(source), tensor_type, tuple(outputs) if outputs else None)
+        if key not in self._output_dictionaries:
+            self._output_dictionaries[key] = self._build_output_dictionary(
+                source, tensor_type, outputs
+            )
+        return dict(self._output_dictionaries[key])
+
+    def _build_output_dictionary(
+        self, source: Path, tensor_type: str, outputs: List[str] = None
+    ) -> dict:
+        """
+        Backend-specific construction of :meth:`build_output_dictionary`.
+        """
+        raise NotImplementedError
+
+    def build_tensor_entities(self, tensor_type: str) -> MappingProxyType:
+        """
+        Get the BIDS entities shared by all of *tensor_type*'s outputs,
+        built once per tensor type.
+
+        Parameters
+        ----------
+        tensor_type : str
+            The tensor estimation method (either "dt" or "dk")
+
+        Returns
+        -------
+        MappingProxyType
+            Entities replacing a source DWI's ones (all but "desc")
+        """
+        return self._tensor_entities[tensor_type]
+
+    def map_kwargs_to_workflow(self, inputs: dict) -> dict:
+        """
+        Maps inputs' dictionary's keys to their corresponding kwargs in
+        relevant Workflows.
+
+        Parameters
+        ----------
+        inputs : dict
+            A dictionary with keys of inputs and values of their corresponding
+            paths
+
+        Returns
+        -------
+        dict
+            The same dictionary with keys that match workflows' kwargs
+        """
+        # Inputs located by the manager are already strings (which str()
+        # returns as are); other paths are converted
+        return {
+            self.TENSOR_FITTING_KWARGS.get(key) or key: str(val)
+            for key, val in inputs.items()
+        }
+
+    def build_workflow_kwargs(self, inputs: dict, tensor_type: str) -> dict:
+        """
+        Build the kwargs of *tensor_type*'s workflow for a single input set.
+
+        Parameters
+        ----------
+        inputs : dict
+            A dictionary with keys of inputs and values of their corresponding
+            paths
+        tensor_type : str
+            The tensor estimation method (either "dt" or "dk")
+
+        Returns
+        -------
+        dict
+            Workflow's kwargs of *inputs* and *tensor_type*'s fitting options
+        """
+        return {
+            **self.map_kwargs_to_workflow(inputs),
+            **self._tensor_kwargs[tensor_type],
+        }
+
+    def validate_single_subject_run(
+        self,
+        participant_label: str,
+        session: Union[List, str] = None,
+        tensor_type: Union[List, str] = None,
+        out_metrics: Union[List, str] = None,
+    ) -> Tuple[List, List, List]:
+        """
+        Validates the requested single-subject run's properties
+
+        Parameters
+        ----------
+        participant_label : str
+            Specific participants' labels to be queried
+        session : Union[List, str], optional
+            Specific session's ID, by default None
+        tensor_type : Union[List, str], optional
+            The tensor estimation method (either "dt" or "dk")
+        out_metrics : Union[List, str], optional
+            Requested tensor-derived outputs, by default All available, by
+            default None
+
+        Returns
+        -------
+        Tuple[List, List, List]
+            Validated tensor estimation protocol, sessions and output metrics
+        """
+        if participant_label not in self.subjects:
+            raise ValueError(
+                INVALID_PARTICIPANT.format(
+                    base_dir=self.data_grabber.base_dir,
+                    participant_label=participant_label,
+                )
+            )
+        tensor_types = tensor_type or list(self.TENSOR_TYPES.keys())
+        if isinstance(tensor_type, str):
+            tensor_types = [tensor_type]
+        sessions = session or self.subjects.get(participant_label)
+        if isinstance(sessions, str):
+            sessions = [sessions]
+        if isinstance(out_metrics, str):
+            out_metrics = [out_metrics]
+        return tensor_types, sessions, out_metrics
+
+    def run_single_input(
+        self,
+        inputs: dict,
+        tensor_type: str,
+        out_metrics: list = None,
+        force: bool = False,
+    ) -> dict:
+        """
+        Runs a single input set (DWI and its corresponding files), as
+        implemented by each tensor estimation backend
+
+        Parameters
+        ----------
+        inputs : dict
+            A dictionary with keys of ["dwi","bval","bvec","mask"]
+        tensor_type : str
+            The tensor estimation method (either "dt" or "dk")
+        out_metrics : list
+            Requested tensor-derived outputs, by default All available, by
+            default None
+        force : bool
+            Whether to force the creation of outputs (rather than keeping
+            pre-existing ones), by default False
+
+        Returns
+        -------
+        dict
+            Dictionary with requested outputs as keys and their corresponding
+            generated files' paths as values.
+        """
+        raise NotImplementedError
+
+    def run_single_session(
+        self,
+        participant_label: str,
+        session: str,
+        tensor_types: list,
+        out_metrics: list = None,
+        force: bool = False,
+    ) -> dict:
+        """
+        Locates session-specific DWI-related files and estimates their
+        tensor-derived metrics.
+
+        Parameters
+        ----------
+        participant_label : str
+            Specific participants' labels to be analyzed
+        session : str
+            Specific session's ID
+        tensor_types : list
+            The tensor estimation method(s) (either "dt" or "dk")
+        out_metrics : list
+            Requested tensor-derived outputs, by default All available, by
+            default None
+        force : bool
+            Whether to force the creation of outputs (rather than keeping
+            pre-existing ones), by default False
+
+        Returns
+        -------
+        dict
+            A dictionary with *tensor_types* as keys and a list of
+            tensor-derived metrics as values
+        """
+        dwis = self.get_subject_dwi(
+            participant_label, session, queries=self.DWI_QUERY_ENTITIES
+        )
+        result = {}
+        for tensor_type in tensor_types:
+            result[tensor_type] = []
+            for inputs in dwis:
+                outputs = self.run_single_input(
+                    inputs, tensor_type, out_metrics, force
+                )
+                if outputs is not None:
+                    result[tensor_type].append(outputs)
+        return result
+
+    def collect_subject_jobs(
+        self, participant_label: str, sessions: list, tensor_types: list
+    ) -> List[Tuple[str, str, dict]]:
+        """
+        Collect the (session, tensor type, inputs) jobs of all of
+        *participant_label*'s DWIs under *sessions*.
+
+        Parameters
+        ----------
+        participant_label : str
+            Specific participants' labels to be queried
+        sessions : list
+            Specific sessions' IDs
+        tensor_types : list
+            The tensor estimation method(s) (either "dt" or "dk")
+
+        Returns
+        -------
+        List[Tuple[str, str, dict]]
+            Jobs of (session, tensor type, DWI's inputs)
+        """
+        jobs = []
+        for session in sessions:
+            dwis = self.get_subject_dwi(
+                participant_label, session, queries=self.DWI_QUERY_ENTITIES
+            )
+            for tensor_type in tensor_types:
+                jobs.extend((session, tensor_type, inputs) for inputs in dwis)
+        return jobs
+
+    @staticmethod
+    def resolve_n_jobs(n_jobs: int, n_tasks: int) -> int:
+        """
+        Resolve the number of concurrent workers running *n_tasks* tasks.
+
+        Parameters
+        ----------
+        n_jobs : int
+            Requested number of workers, where None stands for all available
+            CPUs (or 1 within a worker process or thread, e.g. of a
+            parcellation)
+        n_tasks : int
+            Number of tasks to run
+
+        Returns
+        -------
+        int
+            Number of workers (at most *n_tasks*)
+        """
+        nested = (
+            multiprocessing.current_process().name != "MainProcess"
+            or threading.current_thread() is not threading.main_thread()
+        )
+        if n_jobs is None and nested:
+            n_jobs = 1
+        return min(n_tasks, n_jobs or os.cpu_count() or 1)
+
+    def run_inputs(
+        self,
+        jobs: List[Tuple[dict, str]],
+        out_metrics: list = None,
+        force: bool = False,
+        n_jobs: int = None,
+    ) -> List[dict]:
+        """
+        Run (DWI inputs, tensor type) *jobs*, in parallel processes where
+        more than a single worker is available.
+
+        Parameters
+        ----------
+        jobs : List[Tuple[dict, str]]
+            Pairs of DWI inputs (see :meth:`run_single_input`) and tensor
+            type
+        out_metrics : list, optional
+            Requested tensor-derived outputs, by default All available
+        force : bool
+            Whether to force the creation of outputs (rather than keeping
+            pre-existing ones), by default False
+        n_jobs : int, optional
+            Number of worker processes (1 to run serially), by default all
+            available CPUs (or 1 within a worker process, e.g. of a
+            parcellation)
+
+        Returns
+        -------
+        List[dict]
+            Each job's outputs (see :meth:`run_single_input`), in order, with
+            None for fittings that failed (where a backend reports so)
+        """
+        n_jobs = self.resolve_n_jobs(n_jobs, len(jobs))
+        if n_jobs <= 1:
+            return [
+                self.run_single_input(inputs, tensor_type, out_metrics, force)
+                for inputs, tensor_type in jobs
+            ]
+        # Batch jobs of the same gradients' scheme (and each DWI's tensor
+        # types consecutively), so that each worker reuses its manager,
+        # design matrices and loaded DWI across them, while keeping at least
+        # one batch per worker.
+        order = sorted(
+            range(len(jobs)),
+            key=lambda i: (
+                *(
+                    Path(jobs[i][0][key]).read_text()
+                    for key in ["bval", "bvec"]
+                ),
+                str(jobs[i][0]["dwi"]),
+                jobs[i][1],
+            ),
+        )
+        batch_size = max(1, min(JOBS_PER_BATCH, len(jobs) // n_jobs))
+        batches = [
+            order[start : start + batch_size]  # noqa: E203
+            for start in range(0, len(order), batch_size)
+        ]
+        outputs = [None] * len(jobs)
+        # Split the cores between workers, so that multi-threaded fits (and
+        # MRtrix3's commands) still use all of them when jobs are few
+        with ProcessPoolExecutor(
+            max_workers=n_jobs,
+            initializer=limit_blas_threads,
+            initargs=((os.cpu_count() or 1) // n_jobs,),
+        ) as executor:
+            futures = {
+                executor.submit(
+                    _run_input_batch,
+                    type(self),
+                    self.get_estimator_kwargs(),
+                    self.data_grabber.base_dir,
+                    self.data_grabber.database_path,
+                    list(self.participant_labels),
+                    [jobs[i] for i in batch],
+                    out_metrics,
+                    force,
+                ): batch
+                for batch in batches
+            }
+            for future in iterate_completed(futures):
+                for i, job_outputs in zip(futures[future], future.result()):
+                    outputs[i] = job_outputs
+        return outputs
+
+    def run_single_subject(
+        self,
+        participant_label: str,
+        session: Union[List, str] = None,
+        tensor_type: Union[List, str] = None,
+        out_metrics: Union[List, str] = None,
+        force: bool = False,
+        n_jobs: int = None,
+    ) -> dict:
+        """
+        Run tensor-derived metrics' estimation for all available DWIs under
+        *participant_label*, estimating (DWI, tensor type) pairs in parallel
+        processes.
+
+        Parameters
+        ----------
+        participant_label : str
+            Specific participants' labels to be queried
+        session : Union[List, str], optional
+            Specific session's ID, by default None
+        tensor_type : Union[List, str], optional
+            The tensor estimation method (either "dt" or "dk")
+        out_metrics : Union[List, str], optional
+            Requested tensor-derived outputs, by default All available, by
+            default None
+        force : bool
+            Whether to force the creation of outputs (rather than keeping
+            pre-existing ones), by default False
+        n_jobs : int, optional
+            Number of worker processes (1 to run serially), by default all
+            available CPUs
+
+        Returns
+        -------
+        dict
+            A nested dictionary with sessions as keys and a dictionary for
+            each *tensor_type* as values
+        """
+        tensor_types, sessions, out_metrics = self.validate_single_subject_run(
+            participant_label, session, tensor_type, out_metrics
+        )
+        jobs = self.collect_subject_jobs(
+            participant_label, sessions, tensor_types
+        )
+        outputs = self.run_inputs(
+            [(inputs, tensor_type) for _, tensor_type, inputs in jobs],
+            out_metrics,
+            force,
+            n_jobs,
+        )
+        result = {
+            session: {tensor_type: [] for tensor_type in tensor_types}
+            for session in sessions
+        }
+        for (session, tensor_type, _), job_outputs in zip(jobs, outputs):
+            # Failed fittings' outputs (None) are left out
+            if job_outputs is not None:
+                result[session][tensor_type].append(job_outputs)
+        return result
+
+    def run_dataset(
+        self,
+        participant_label: Union[str, list] = None,
+        tensor_type: Union[List, str] = None,
+        out_metrics: Union[List, str] = None,
+        force: bool = False,
+        n_jobs: int = None,
+    ) -> dict:
+        """
+        Run tensor estimation for an entire dataset, estimating all
+        participants' (DWI, tensor type) pairs within a single pool of
+        worker processes.
+
+        Parameters
+        ----------
+        participant_label : Union[str, list], optional
+            Specific subject/s within the dataset to run, by default None
+        tensor_type : Union[List, str], optional
+            Type of tensor estimation to perform, by default All implemented
+        out_metrics : Union[List, str], optional
+            Specific metric of the tensor to produce, by default All
+        force : bool, optional
+            Whether to remove existing products and generate new ones, by default False # noqa
+        n_jobs : int, optional
+            Number of worker processes (1 to run serially), by default all available CPUs
+
+        Returns
+        -------
+        dict
+            Dictionary with keys of subjects and values of session-wise tensor estimation's products
+        """
+        tensor_metrics = {}
+        if isinstance(participant_label, str):
+            participant_labels = [participant_label]
+        else:
+            participant_labels = list(participant_label or self.subjects)
+        # Index the participants' files with a single layout query upfront
+        self.data_grabber.index_subjects(participant_labels)
+        jobs = []
+        for participant_label in participant_labels:
+            try:
+                sessions = self.subjects.get(participant_label)
+                (
+                    tensor_types,
+                    sessions,
+                    out_metrics,
+                ) = self.validate_single_subject_run(
+                    participant_label, sessions, tensor_type, out_metrics
+                )
+                subject_jobs = self.collect_subject_jobs(
+                    participant_label, sessions, tensor_types
+                )
+            except (KeyError, FileNotFoundError):
+                continue
+            tensor_metrics[participant_label] = {
+                session: {tensor_type: [] for tensor_type in tensor_types}
+                for session in sessions
+            }
+            jobs.extend((participant_label, *job) for job in subject_jobs)
+        outputs = self.run_inputs(
+            [(inputs, tensor_type) for _, _, tensor_type, inputs in jobs],
+            out_metrics,
+            force,
+            n_jobs,
+        )
+        for (participant_label, session, tensor_type, _), job_outputs in zip(
+            jobs, outputs
+        ):
+            if job_outputs is None:
+                continue
+            tensor_metrics[participant_label][session][tensor_type].append(
+                job_outputs
+            )
+        return tensor_metrics
@@ -0,0 +1,477 @@
+"""
+Linear (OLS/WLS) diffusion tensor and kurtosis fitting, reusing design
+matrices across DWIs that share an acquisition scheme.
+"""
+import io
+import os
+from functools import lru_cache
+from pathlib import Path
+from typing import Tuple
+
+import nibabel as nib
+import numpy as np
+from dipy.core.gradients import GradientTable, gradient_table
+from dipy.reconst import dki, dti
+
+from qsiprep_analyses.tensors._kernels import (
+    DTI_SCALARS,
+    compute_dti_metrics,
+    fit_wls,
+)
+
+#: Fitting methods solved directly from the design matrix
+LINEAR_FIT_METHODS = ("WLS", "OLS")
+
+#: Design matrices' builders of the linearly fitted models
+DESIGN_MATRICES = dict(dti=dti.design_matrix, dki=dki.design_matrix)
+
+#: Upper bound of kurtosis metrics (as in dipy's kurtosis fits)
+MAX_KURTOSIS = 10
+
+#: Tolerance of the minimal diffusivity (as in dipy's tensor fits)
+DIFFUSIVITY_TOLERANCE = 1e-6
+
+
+def _get_cache_size(default: int = 2**22) -> int:
+    """
+    Probe the size (in bytes) of the CPU's L2 cache, where available.
+    """
+    try:
+        size = os.sysconf("SC_LEVEL2_CACHE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        size = 0
+    return size if size > 0 else default
+
+
+#: Bytes of (float32) signal fitted at once, kept within the L2 cache
+CHUNK_BYTES = _get_cache_size()
+#: Minimal number of voxels fitted at once
+MIN_CHUNK_VOXELS = 1024
+
+#: (row, column) indices of the lower-triangular tensor coefficients
+LOWER_TRIANGULAR = ((0, 0), (0, 1), (1, 1), (0, 2), (1, 2), (2, 2))
+
+
+def _dti_metric(name: str):
+    index = DTI_SCALARS.index(name)
+    return lambda evals, evecs: compute_dti_metrics(evals)[index]
+
+
+#: Tensor-derived metrics, computed from (descending) eigenvalues and
+#: their corresponding (columnar) eigenvectors
+TENSOR_METRICS = dict(
+    fa=_dti_metric("fa"),
+    ga=lambda evals, evecs: dti.geodesic_anisotropy(evals),
+    rgb=lambda evals, evecs: np.array(
+        255 * dti.color_fa(compute_dti_metrics(evals)[0], evecs), "uint8"
+    ),
+    md=_dti_metric("md"),
+    adc=_dti_metric("md"),
+    ad=_dti_metric("ad"),
+    rd=_dti_metric("rd"),
+    cl=lambda evals, evecs: dti.linearity(evals),
+    cp=lambda evals, evecs: dti.planarity(evals),
+    cs=lambda evals, evecs: dti.sphericity(evals),
+    mode=lambda evals, evecs: dti.mode(dti.vec_val_vect(evecs, evals)),
+    eval=lambda evals, evecs: evals,
+    evec=lambda evals, evecs: evecs,
+    value=lambda evals, evecs: evals[..., 0],
+    vector=lambda evals, evecs: evecs[..., 0],
+    dt_tensor=lambda evals, evecs: dti.lower_triangular(
+        dti.vec_val_vect(evecs, evals)
+    )[..., [0, 1, 3, 2, 4, 5]],
+)
+
+#: Kurtosis-derived metrics, computed from dipy's (N, 27) kurtosis model's
+#: parameters
+KURTOSIS_METRICS = dict(
+    mk=lambda params: dki.mean_kurtosis(params, max_kurtosis=MAX_KURTOSIS),
+    ak=lambda params: dki.axial_kurtosis(params, max_kurtosis=MAX_KURTOSIS),
+    rk=lambda params: dki.radial_kurtosis(params, max_kurtosis=MAX_KURTOSIS),
+    dk_tensor=lambda params: params[:, 12:],
+)
+
+
+@lru_cache(maxsize=16)
+def _get_gradient_table(bvals: str, bvecs: str) -> GradientTable:
+    """
+    Build a gradient scheme's table once, shared by its models' design
+    matrices.
+    """
+    bvals = np.loadtxt(io.StringIO(bvals), ndmin=1)
+    bvecs = np.loadtxt(io.StringIO(bvecs), ndmin=2)
+    if bvecs.shape[1] > bvecs.shape[0]:
+        bvecs = bvecs.T
+    return gradient_table(bvals, bvecs=bvecs)
+
+
+@lru_cache(maxsize=16)
+def _get_design_pinv(
+    bvals: str, bvecs: str, model: str = "dti"
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Build the *model*'s design matrix of a gradient scheme and its
+    pseudo-inverse. Cached by the gradients' contents, so that sessions and
+    subjects sharing an acquisition scheme compute them once.
+    """
+    design = DESIGN_MATRICES[model](_get_gradient_table(bvals, bvecs))
+    pinv = np.linalg.pinv(design).astype(np.float32)
+    for array in design, pinv:
+        array.setflags(write=False)
+    return design, pinv
+
+
+def get_design_pinv(
+    bval: Path, bvec: Path, model: str = "dti"
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Locate the (cached) design matrix and its pseudo-inverse for a DWI's
+    gradients.
+
+    Parameters
+    ----------
+    bval : Path
+        Path to the DWI's .bval file
+    bvec : Path
+        Path to the DWI's .bvec file
+    model : str, optional
+        Either "dti" or "dki" (see :data:`DESIGN_MATRICES`), by default "dti"
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        The (G, 7) (or (G, 22) for "dki") design matrix and its pseudo-inverse
+    """
+    return _get_design_pinv(
+        Path(bval).read_text(), Path(bvec).read_text(), model
+    )
+
+
+def fit_tensor(
+    signal: np.ndarray,
+    design: np.ndarray,
+    pinv: np.ndarray,
+    fit_method: str = "WLS",
+    use_gpu: bool = False,
+) -> np.ndarray:
+    """
+    Fit the (lower-triangular) tensor coefficients of all voxels at once.
+
+    Parameters
+    ----------
+    signal : np.ndarray
+        (N, G) array of the DWI signal of N voxels
+    design : np.ndarray
+        (G, C) design matrix
+    pinv : np.ndarray
+        (C, G) pseudo-inverse of *design*
+    fit_method : str, optional
+        Either "WLS" or "OLS", by default "WLS"
+    use_gpu : bool, optional
+        Whether to solve WLS fits on a GPU where available (see
+        :func:`fit_wls`), by default False
+
+    Returns
+    -------
+    np.ndarray
+        (N, C) array of tensor (and kurtosis) coefficients (and log(S0))
+    """
+    log_signal = np.log(np.maximum(signal, dti.MIN_POSITIVE_SIGNAL))
+    if fit_method == "OLS":
+        return log_signal @ pinv.T
+    return fit_wls(log_signal, design, pinv, use_gpu)
+
+
+def decompose_tensor(
+    coefficients: np.ndarray, min_diffusivity: float = 0
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Eigen-decompose the tensors of all voxels with a single batched (float32)
+    call.
+
+    Parameters
+    ----------
+    coefficients : np.ndarray
+        (N, 6) array of lower-triangular tensor coefficients
+    min_diffusivity : float, optional
+        Lower bound of the eigenvalues, by default 0
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        (N, 3) descending eigenvalues and (N, 3, 3) eigenvectors (as columns)
+    """
+    rows, columns = zip(*LOWER_TRIANGULAR)
+    tensor = np.empty((len(coefficients), 3, 3), dtype=np.float32)
+    tensor[:, rows, columns] = coefficients[:, :6]
+    tensor[:, columns, rows] = coefficients[:, :6]
+    evals, evecs = np.linalg.eigh(tensor)
+    evals = np.clip(evals[:, ::-1], min_diffusivity, None)
+    return evals, evecs[:, :, ::-1]
+
+
+@lru_cache(maxsize=1)
+def _load_signal_masked(
+    dwi: str, mask: str, stamps: tuple
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Load a DWI's signal of its foreground voxels. Cached for the last DWI (by
+    its files' modification times), which is fitted by each of its tensor
+    types in turn.
+    """
+    img = nib.load(dwi, mmap=True)
+    # Read the stored (unscaled) values, so that a scaled image is never
+    # expanded into a whole float64 volume, and scale its foreground only
+    data = img.dataobj.get_unscaled()
+    slope, inter = img.dataobj.slope, img.dataobj.inter
+    if mask:
+        mask = np.asanyarray(nib.load(mask).dataobj).astype(bool)
+    else:
+        threshold = -inter / slope
+        above = data > threshold if slope > 0 else data < threshold
+        mask = np.any(above, axis=-1)
+    signal = data.reshape(-1, data.shape[-1])[mask.ravel()]
+    del data
+    if (slope, inter) != (1, 0):
+        signal = signal.astype(np.float32)
+        signal *= np.float32(slope)
+        signal += np.float32(inter)
+    for array in signal, mask:
+        array.setflags(write=False)
+    return signal, mask, img.affine
+
+
+def load_signal_masked(
+    dwi: Path, mask: Path = None
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Load a DWI's signal over its foreground voxels only. The signal is
+    masked before its conversion to floats, so that no linear algebra (or
+    memory) is spent on the background.
+
+    Parameters
+    ----------
+    dwi : Path
+        Path to a preprocessed DWI
+    mask : Path, optional
+        Path to the DWI's brain mask, by default all voxels with signal
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray, np.ndarray]
+        The (read-only) (N, G) signal of foreground voxels, the (boolean)
+        mask and the DWI's affine
+    """
+    mask = str(mask) if mask and Path(mask).exists() else None
+    paths = [str(dwi)] + ([mask] if mask else [])
+    stamps = tuple(os.stat(path).st_mtime_ns for path in paths)
+    return _load_signal_masked(str(dwi), mask, stamps)
+
+
+def _fit_tensor_masked(
+    dwi: Path,
+    design: np.ndarray,
+    pinv: np.ndarray,
+    mask: Path = None,
+    fit_method: str = "WLS",
+    use_gpu: bool = False,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Fit a DWI's diffusion tensor (or kurtosis) model over its foreground
+    voxels only (see :func:`load_signal_masked`), in cache-sized chunks of
+    voxels (on a GPU too, so that a chunk exceeding its memory falls back to
+    the CPU on its own).
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray, np.ndarray]
+        The fitted voxels' (N, 6) tensor (or (N, 21) tensor and kurtosis)
+        coefficients, the (boolean) mask and the DWI's affine
+    """
+    signal, mask, affine = load_signal_masked(dwi, mask)
+    n_voxels, n_gradients = signal.shape
+    chunk_size = max(MIN_CHUNK_VOXELS, CHUNK_BYTES // (4 * n_gradients))
+    n_coefficients = design.shape[1] - 1
+    coefficients = np.empty((n_voxels, n_coefficients), dtype=np.float32)
+    for start in range(0, n_voxels, chunk_size):
+        chunk = slice(start, start + chunk_size)
+        coefficients[chunk] = fit_tensor(
+            signal[chunk].astype(np.float32, copy=False),
+            design,
+            pinv,
+            fit_method,
+            use_gpu,
+        )[:, :n_coefficients]
+    return coefficients, mask, affine
+
+
+def _load_tensor_masked(
+    coefficients: Path,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Load previously fitted tensor coefficients (see :func:`estimate_tensor`).
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray, np.ndarray]
+        The fitted voxels' (N, 6) tensor coefficients, the (boolean) mask and
+        the DWI's affine
+    """
+    img = nib.load(coefficients)
+    volume = np.asanyarray(img.dataobj)
+    mask = np.any(volume != 0, axis=-1)
+    return volume[mask], mask, img.affine
+
+
+def _is_up_to_date(path: Path, *sources: Path) -> bool:
+    """
+    Check whether *path* exists and is at least as new as the newest of its
+    (given) *sources*, with a single stat() of each.
+    """
+    try:
+        newest = max(os.stat(source).st_mtime for source in sources if source)
+        return os.stat(path).st_mtime >= newest
+    except FileNotFoundError:
+        return False
+
+
+def _save_masked(
+    values: np.ndarray, mask: np.ndarray, affine: np.ndarray, path: Path
+) -> None:
+    """
+    Scatter masked voxels' *values* into a (float32, unless unsigned
+    integers) volume and save it.
+    """
+    dtype = values.dtype if values.dtype.kind == "u" else np.float32
+    volume = np.zeros(mask.shape + values.shape[1:], dtype=dtype)
+    volume[mask] = values
+    nib.save(nib.Nifti1Image(volume, affine), path)
+
+
+def estimate_tensor(
+    dwi: Path,
+    bval: Path,
+    bvec: Path,
+    outputs: dict,
+    mask: Path = None,
+    fit_method: str = "WLS",
+    coefficients: Path = None,
+    force: bool = False,
+    use_gpu: bool = False,
+) -> dict:
+    """
+    Fit a DWI's diffusion tensor and save its requested derived metrics.
+    Where *coefficients* is given, the fitted tensor is saved to it and
+    reused as long as it is newer than its inputs, so that new metrics do
+    not require refitting.
+
+    Parameters
+    ----------
+    dwi : Path
+        Path to a preprocessed DWI
+    bval : Path
+        Path to the DWI's .bval file
+    bvec : Path
+        Path to the DWI's .bvec file
+    outputs : dict
+        A dictionary with keys of "out_<metric>" (see :data:`TENSOR_METRICS`)
+        and values of their corresponding paths
+    mask : Path, optional
+        Path to the DWI's brain mask, by default all voxels with signal
+    fit_method : str, optional
+        Either "WLS" or "OLS", by default "WLS"
+    coefficients : Path, optional
+        Path to the fitted tensor coefficients, by default None
+    force : bool, optional
+        Whether to refit the tensor even if *coefficients* are up to date,
+        by default False
+    use_gpu : bool, optional
+        Whether to solve WLS fits on a GPU where available, by default False
+
+    Returns
+    -------
+    dict
+        The same *outputs* dictionary
+    """
+    design, pinv = get_design_pinv(bval, bvec)
+    sources = dwi, bval, bvec, mask if mask and Path(mask).exists() else None
+    if coefficients and not force and _is_up_to_date(coefficients, *sources):
+        tensor, mask, affine = _load_tensor_masked(coefficients)
+    else:
+        tensor, mask, affine = _fit_tensor_masked(
+            dwi, design, pinv, mask, fit_method, use_gpu
+        )
+        if coefficients:
+            _save_masked(tensor, mask, affine, coefficients)
+    evals, evecs = decompose_tensor(
+        tensor, DIFFUSIVITY_TOLERANCE / -design.min()
+    )
+    scalars = dict(zip(DTI_SCALARS, compute_dti_metrics(evals)))
+    scalars["adc"] = scalars["md"]
+    for key, path in outputs.items():
+        metric = key.replace("out_", "", 1)
+        values = scalars.get(metric)
+        if values is None:
+            values = TENSOR_METRICS[metric](evals, evecs)
+        _save_masked(values, mask, affine, path)
+    return outputs
+
+
+def estimate_kurtosis(
+    dwi: Path,
+    bval: Path,
+    bvec: Path,
+    outputs: dict,
+    mask: Path = None,
+    fit_method: str = "WLS",
+    use_gpu: bool = False,
+) -> dict:
+    """
+    Fit a DWI's diffusion kurtosis model and save its requested derived
+    metrics.
+
+    Parameters
+    ----------
+    dwi : Path
+        Path to a preprocessed DWI
+    bval : Path
+        Path to the DWI's .bval file
+    bvec : Path
+        Path to the DWI's .bvec file
+    outputs : dict
+        A dictionary with keys of "out_<metric>" (see :data:`TENSOR_METRICS`
+        and :data:`KURTOSIS_METRICS`) and values of their corresponding paths
+    mask : Path, optional
+        Path to the DWI's brain mask, by default all voxels with signal
+    fit_method : str, optional
+        Either "WLS" or "OLS", by default "WLS"
+    use_gpu : bool, optional
+        Whether to solve WLS fits on a GPU where available, by default False
+
+    Returns
+    -------
+    dict
+        The same *outputs* dictionary
+    """
+    design, pinv = get_design_pinv(bval, bvec, model="dki")
+    coefficients, mask, affine = _fit_tensor_masked(
+        dwi, design, pinv, mask, fit_method, use_gpu
+    )
+    evals, evecs = decompose_tensor(
+        coefficients, DIFFUSIVITY_TOLERANCE / -design.min()
+    )
+    # Kurtosis coefficients are fitted scaled by the (clipped, hence
+    # positive) squared mean diffusivity
+    _, md, _, _ = compute_dti_metrics(evals)
+    kurtosis = coefficients[:, 6:] / np.square(md)[:, None]
+    params = np.concatenate(
+        [evals, evecs.reshape(-1, 9), kurtosis], axis=-1
+    ).astype(np.float64)
+    for key, path in outputs.items():
+        metric = key.replace("out_", "", 1)
+        if metric in KURTOSIS_METRICS:
+            values = KURTOSIS_METRICS[metric](params)
+        else:
+            values = TENSOR_METRICS[metric](evals, evecs)
+        _save_masked(values, mask, affine, path)
+    return outputs
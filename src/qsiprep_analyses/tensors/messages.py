@@ -4,3 +4,5 @@ INVALID_PARTICIPANT = "participant_label must describe an existing participant i
 #: Warnings
 INVALID_OUTPUT = """Requested output {output} is not a valid ({tensor_type}) tensor-derived metric.
 Available metrics are: {available_metrics}"""  # noqa: E501
+TENSOR_FITTING_FAILED = """MRtrix3's tensor fitting of {source} failed (exit code {code}):
+{stderr}"""  # noqa: E501
@@ -3,111 +3,83 @@ Definition of the :class:`TensorEstimation` class.
 """
 import warnings
 from pathlib import Path
-from typing import List, Tuple, Union
+from types import MappingProxyType
+from typing import List, Union
 
-import tqdm
 from dipy.workflows.reconst import ReconstDkiFlow, ReconstDtiFlow
 
-from qsiprep_analyses.manager import QsiprepManager
-from qsiprep_analyses.tensors.messages import (
-    INVALID_OUTPUT,
-    INVALID_PARTICIPANT,
-    TENSOR_RECONSTRUCTION_NOT_IMPLEMENTED,
+from qsiprep_analyses.tensors.base import BaseTensorEstimation
+from qsiprep_analyses.tensors.fitting import (
+    KURTOSIS_METRICS,
+    LINEAR_FIT_METHODS,
+    TENSOR_METRICS,
+    estimate_kurtosis,
+    estimate_tensor,
 )
 from qsiprep_analyses.tensors.utils import (
-    DWI_ENTITIES,
-    KWARGS_MAPPING,
-    TENSOR_DERIVED_ENTITIES,
-    TENSOR_DERIVED_METRICS,
+    TENSOR_COEFFICIENTS_DESC,
+    TENSOR_METRICS_DESCRIPTIONS,
 )
+from qsiprep_analyses.utils.data_grabber import DataGrabber
+from qsiprep_analyses.utils.utils import all_exist
 
 
-class TensorEstimation(QsiprepManager):
-    #: Templates
-    DWI_QUERY_ENTITIES = DWI_ENTITIES.copy()
-    TENSOR_ENTITIES = TENSOR_DERIVED_ENTITIES.copy()
-    METRICS = TENSOR_DERIVED_METRICS.copy()
+class TensorEstimation(BaseTensorEstimation):
+    #: Outputs' BIDS descriptions
+    OUTPUT_DESCRIPTIONS = TENSOR_METRICS_DESCRIPTIONS
 
     #: Tensor Workflows
-    TENSOR_FITTING_KWARGS = KWARGS_MAPPING
     TENSOR_WORKFLOWS = {
         "diffusion_tensor": ReconstDtiFlow,
         "diffusion_kurtosis": ReconstDkiFlow,
         "restore_tensor": ReconstDtiFlow,
     }
     #: Tensor types
-    TENSOR_TYPES = dict(
-        diffusion_tensor={"acq": "dt", "fit_method": "WLS"},
-        diffusion_kurtosis={"acq": "dk", "fit_method": "WLS"},
-        restore_tensor={"acq": "rt", "fit_method": "restore"},
+    TENSOR_TYPES = MappingProxyType(
+        dict(
+            diffusion_tensor=MappingProxyType(
+                {"acq": "dt", "fit_method": "WLS"}
+            ),
+            diffusion_kurtosis=MappingProxyType(
+                {"acq": "dk", "fit_method": "WLS"}
+            ),
+            restore_tensor=MappingProxyType(
+                {"acq": "rt", "fit_method": "restore"}
+            ),
+        )
     )
 
     def __init__(
         self,
-        base_dir: Path,
+        base_dir: Path = None,
         participant_labels: Union[str, list] = None,
+        data_grabber: DataGrabber = None,
+        use_fast_fit: bool = True,
+        use_gpu: bool = False,
     ) -> None:
-        super().__init__(base_dir, participant_labels)
+        super().__init__(base_dir, participant_labels, data_grabber)
+        self.use_fast_fit = use_fast_fit
+        self.use_gpu = use_gpu
 
-    def validate_tensor_type(self, tensor_type: str) -> None:
+    def get_estimator_kwargs(self) -> dict:
         """
-        Validates *tensor_type* as an implemented tensor estimation protocol.
-
-        Parameters
-        ----------
-        tensor_type : str
-            The tensor estimation method (either "dt" or "dk")
-
-        Raises
-        ------
-        NotImplementedError
-            In case *tensor_type* is not an implemented key of recognized
-            tensor-estimation protocol
-        """
-        if tensor_type not in self.TENSOR_TYPES:
-            raise NotImplementedError(
-                TENSOR_RECONSTRUCTION_NOT_IMPLEMENTED.format(
-                    tensor_type=tensor_type
-                )
-            )
-        return self.TENSOR_TYPES.get(tensor_type)
-
-    def validate_requested_output(self, tensor_type: str, output: str) -> bool:
-        """
-        Validates a requested output to be a valid *tensor_type* derived metric
-
-        Parameters
-        ----------
-        tensor_type : str
-            The tensor estimation method (either "dt" or "dk")
-        output : str
-            The requested output
+        Keyword arguments (besides the participants' labels and data grabber)
+        rebuilding an equivalent estimator within worker processes.
 
         Returns
         -------
-        bool
-            Whether the requested *output* is a valid output of *tensor_type*
-            derived metrics
+        dict
+            Backend-specific kwargs of the estimator's initialization
         """
-        if output in self.METRICS.get(tensor_type):
-            return True
-        else:
-
-            warnings.warn(
-                INVALID_OUTPUT.format(
-                    output=output,
-                    tensor_type=tensor_type,
-                    available_metrics=", ".join(self.METRICS.get(tensor_type)),
-                )
-            )
-            return False
+        return dict(use_fast_fit=self.use_fast_fit, use_gpu=self.use_gpu)
 
-    def build_output_dictionary(
+    def _build_output_dictionary(
         self, source: Path, tensor_type: str, outputs: List[str] = None
     ) -> dict:
         """
-        Based on a *source* DWI, reconstruct output names for tensor-derived
-        metric available under *tensor_type*.
+        Based on a *source* DWI, reconstruct output names (keyed by
+        "out_<metric>") for tensor-derived metric available under
+        *tensor_type*.
 
         Parameters
         ----------
@@ -125,96 +97,44 @@ class TensorEstimation(QsiprepManager):
             corresponding paths
         """
         outputs = outputs or self.METRICS.get(tensor_type)
+        entities = self.build_tensor_entities(tensor_type)
+        build_path = self.data_grabber.build_path
         target = {}
         for output in outputs:
             if self.validate_requested_output(tensor_type, output):
-                output_parts = output.split("_")
-                if len(output_parts) > 1:
-                    output_desc = "".join(
-                        [output_parts[0], output_parts[1].capitalize()]
-                    )
-                else:
-                    output_desc = output
+                output_desc = self.OUTPUT_DESCRIPTIONS[output]
                 target[f"out_{output}"] = str(
-                    self.data_grabber.build_path(
-                        source,
-                        {
-                            "acquisition": self.TENSOR_TYPES.get(
-                                tensor_type
-                            ).get("acq"),
-                            "desc": output_desc,
-                            **self.TENSOR_ENTITIES,
-                        },
-                    )
+                    build_path(source, dict(entities, desc=output_desc))
                 )
 
         return target
 
-    def map_kwargs_to_workflow(self, inputs: dict) -> dict:
+    def build_coefficients_path(self, source: Path, tensor_type: str) -> str:
         """
-        Maps inputs' dictionary's keys to their corresponding kwargs in
-        relevant Workflows.
+        Based on a *source* DWI, reconstruct the name of its fitted tensor
+        coefficients under *tensor_type*.
 
         Parameters
         ----------
-        inputs : dict
-            A dictionary with keys of inputs and values of their corresponding
-            paths
-
-        Returns
-        -------
-        dict
-            The same dictionary with keys that match workflows' kwargs
-        """
-        workflow_kwargs = {}
-        for key, val in inputs.items():
-            kwarg = self.TENSOR_FITTING_KWARGS.get(key) or key
-            workflow_kwargs[kwarg] = str(val)
-        return workflow_kwargs
-
-    def validate_single_subject_run(
-        self,
-        participant_label: str,
-        session: Union[List, str] = None,
-        tensor_type: Union[List, str] = None,
-        out_metrics: Union[List, str] = None,
-    ) -> Tuple[List, List, List]:
-        """
-        Validates the requested single-subject run's properties
-
-        Parameters
-        ----------
-        participant_label : str
-            Specific participants' labels to be queried
-        session : Union[List, str], optional
-            Specific session's ID, by default None
-        tensor_type : Union[List, str], optional
+        source : Path
+            The source DWI file.
+        tensor_type : str
             The tensor estimation method (either "dt" or "dk")
-        out_metrics : Union[List, str], optional
-            Requested tensor-derived outputs, by default All available, by
-            default None
 
         Returns
         -------
-        Tuple[List, List, List]
-            Validated tensor estimation protocol, sessions and output metrics
+        str
+            Path to the fitted tensor coefficients
         """
-        if participant_label not in self.subjects:
-            raise ValueError(
-                INVALID_PARTICIPANT.format(
-                    base_dir=self.data_grabber.base_dir,
-                    participant_label=participant_label,
-                )
+        return str(
+            self.data_grabber.build_path(
+                source,
+                dict(
+                    self.build_tensor_entities(tensor_type),
+                    desc=TENSOR_COEFFICIENTS_DESC,
+                ),
             )
-        tensor_types = tensor_type or list(self.TENSOR_TYPES.keys())
-        if isinstance(tensor_type, str):
-            tensor_types = [tensor_type]
-        sessions = session or self.subjects.get(participant_label)
-        if isinstance(sessions, str):
-            sessions = [sessions]
-        if isinstance(out_metrics, str):
-            out_metrics = [out_metrics]
-        return tensor_types, sessions, out_metrics
+        )
 
     def run_single_input(
         self,
@@ -246,157 +166,94 @@ class TensorEstimation(QsiprepManager):
             generated files' paths as values.
         """
 
-        tensor_kwargs = self.validate_tensor_type(tensor_type)
+        self.validate_tensor_type(tensor_type)
         outputs = self.build_output_dictionary(
             inputs.get("dwi"),
             tensor_type,
             out_metrics,
         )
-        workflow_kwargs = self.map_kwargs_to_workflow(inputs)
-        if "fit_method" in tensor_kwargs:
-            workflow_kwargs["fit_method"] = tensor_kwargs.get("fit_method")
-        wf = self.TENSOR_WORKFLOWS.get(tensor_type)
-        outputs_exist = [Path(val).exists() for val in outputs.values()]
-        if (not all(outputs_exist)) or (force):
-            with warnings.catch_warnings():
-                warnings.filterwarnings("ignore")
-                runner = wf(force=force)
-                runner.run(**workflow_kwargs, **outputs)
+        if force or not all_exist(outputs.values()):
+            self.run_tensor_workflow(inputs, tensor_type, outputs, force)
 
         return outputs
 
-    def run_single_session(
+    def run_tensor_workflow(
         self,
-        participant_label: str,
-        session: str,
-        tensor_types: list,
-        out_metrics: list = None,
-        force: bool = False,
-    ) -> dict:
-        """
-        Locates session-specific DWI-related files and estimates their
-        tensor-derived metrics.
-
-        Parameters
-        ----------
-        participant_label : str
-            Specific participants' labels to be analyzed
-        session : str
-            Specific session's ID
-        tensor_types : list
-            The tensor estimation method(s) (either "dt" or "dk")
-        out_metrics : list
-            Requested tensor-derived outputs, by default All available, by
-            default None
-        force : bool
-            Whether to force the creation of outputs (rather than keeping
-            pre-existing ones), by default False
-
-        Returns
-        -------
-        dict
-            A dictionary with *tensor_types* as keys and a list of
-            tensor-derived metrics as values
-        """
-        dwis = self.get_subject_dwi(
-            participant_label, session, queries=self.DWI_QUERY_ENTITIES
-        )
-        result = {}
-        for tensor_type in tensor_types:
-            result[tensor_type] = []
-            for inputs in dwis:
-                outputs = self.run_single_input(
-                    inputs, tensor_type, out_metrics, force
-                )
-                result[tensor_type].append(outputs)
-        return result
-
-    def run_single_subject(
-        self,
-        participant_label: str,
-        session: Union[List, str] = None,
-        tensor_type: Union[List, str] = None,
-        out_metrics: Union[List, str] = None,
+        inputs: dict,
+        tensor_type: str,
+        outputs: dict,
         force: bool = False,
-    ) -> dict:
+    ) -> None:
         """
-        Run tensor-derived metrics' estimation for all available DWIs under
-        *participant_label*.
+        Estimates a single input set's tensor and saves its derived
+        *outputs*. Unless disabled by *use_fast_fit*, linear (WLS/OLS)
+        diffusion tensor and kurtosis fits are solved directly (for all
+        voxels at once) from a design matrix shared by DWIs of the same
+        acquisition scheme (on a GPU where available, if enabled by
+        *use_gpu*), and fitted tensors are saved so that later requests of
+        other metrics reuse them. Other fits run their
+        corresponding dipy workflow.
 
         Parameters
         ----------
-        participant_label : str
-            Specific participants' labels to be queried
-        session : Union[List, str], optional
-            Specific session's ID, by default None
-        tensor_type : Union[List, str], optional
+        inputs : dict
+            A dictionary with keys of ["dwi","bval","bvec","mask"]
+        tensor_type : str
             The tensor estimation method (either "dt" or "dk")
-        out_metrics : Union[List, str], optional
-            Requested tensor-derived outputs, by default All available, by
-            default None
+        outputs : dict
+            A dictionary with keys of requested outputs and their
+            corresponding paths
         force : bool
             Whether to force the creation of outputs (rather than keeping
             pre-existing ones), by default False
-
-        Returns
-        -------
-        dict
-            A nested dictionary with sessions as keys and a dictionary for
-            each *tensor_type* as values
         """
-        tensor_types, sessions, out_metrics = self.validate_single_subject_run(
-            participant_label, session, tensor_type, out_metrics
-        )
-        result = {}
-        for session in sessions:
-            result[session] = self.run_single_session(
-                participant_label, session, tensor_types, out_metrics, force
+        tensor_kwargs = self.validate_tensor_type(tensor_type)
+        fit_method = tensor_kwargs.get("fit_method")
+        wf = self.TENSOR_WORKFLOWS.get(tensor_type)
+        metrics = [key.replace("out_", "", 1) for key in outputs]
+        fast_fit = self.use_fast_fit and fit_method in LINEAR_FIT_METHODS
+        if (
+            fast_fit
+            and wf is ReconstDtiFlow
+            and all(metric in TENSOR_METRICS for metric in metrics)
+        ):
+            estimate_tensor(
+                inputs.get("dwi"),
+                inputs.get("bval"),
+                inputs.get("bvec"),
+                outputs,
+                mask=inputs.get("mask"),
+                fit_method=fit_method,
+                coefficients=self.build_coefficients_path(
+                    inputs.get("dwi"), tensor_type
+                ),
+                force=force,
+                use_gpu=self.use_gpu,
             )
-        return result
-
-    def run_dataset(
-        self,
-        participant_label: Union[str, list] = None,
-        tensor_type: Union[List, str] = None,
-        out_metrics: Union[List, str] = None,
-        force: bool = False,
-    ) -> dict:
-        """
-        Run tensor estimation for an entire dataset
-
-        Parameters
-        ----------
-        participant_label : Union[str, list], optional
-            Specific subject/s within the dataset to run, by default None
-        tensor_type : Union[List, str], optional
-            Type of tensor estimation to perform, by default All implemented
-        out_metrics : Union[List, str], optional
-            Specific metric of the tensor to produce, by default All
-        force : bool, optional
-            Whether to remove existing products and generate new ones, by default False # noqa
-
-        Returns
-        -------
-        dict
-            Dictionary with keys of subjects and values of session-wise tensor estimation's products
-        """
-        tensor_metrics = {}
-        if participant_label:
-            if isinstance(participant_label, str):
-                participant_labels = [participant_label]
-            elif isinstance(participant_label, list):
-                participant_labels = [participant_label]
-        else:
-            participant_labels = list(self.subjects.keys())
-        for participant_label in tqdm.tqdm(participant_labels):
-            try:
-                sessions = self.subjects.get(participant_label)
-                tensor_metrics[participant_label] = self.run_single_subject(
-                    participant_label=participant_label,
-                    session=sessions,
-                    tensor_type=tensor_type,
-                    out_metrics=out_metrics,
-                    force=force,
-                )
-            except TypeError:
-                continue
+            return
+        if (
+            fast_fit
+            and wf is ReconstDkiFlow
+            and all(
+                metric in TENSOR_METRICS or metric in KURTOSIS_METRICS
+                for metric in metrics
+            )
+        ):
+            estimate_kurtosis(
+                inputs.get("dwi"),
+                inputs.get("bval"),
+                inputs.get("bvec"),
+                outputs,
+                mask=inputs.get("mask"),
+                fit_method=fit_method,
+                use_gpu=self.use_gpu,
+            )
+            return
+        workflow_kwargs = self.build_workflow_kwargs(inputs, tensor_type)
+        # Only estimate (and save) the requested metrics, rather than all of
+        # the workflow's ones (and their S0 estimation).
+        workflow_kwargs["save_metrics"] = metrics
+        with warnings.catch_warnings():
+            warnings.filterwarnings("ignore")
+            runner = wf(force=force)
+            runner.run(**workflow_kwargs, **outputs)
@@ -1,62 +1,322 @@
-DWI_ENTITIES = dict(suffix="dwi", extension=".nii.gz", space="T1w")
-
-TENSOR_DERIVED_ENTITIES = dict(suffix="dwiref", resolution="dwi")
-
-TENSOR_DERIVED_METRICS = dict(
-    diffusion_tensor=dict(
-        fa="fa",
-        adc="md",
-        ad="ad",
-        rd="rd",
-        cl="cl",
-        cs="cs",
-        cp="cp",
-        value="evec",
-        vector="eval",
-    ),
-    restore_tensor=[
-        "fa",
-        "ga",
-        "rgb",
-        "md",
-        "ad",
-        "rd",
-        "mode",
-        "evec",
-        "eval",
-        "tensor",
-    ],
-    diffusion_kurtosis=[
-        "fa",
-        "ga",
-        "rgb",
-        "md",
-        "ad",
-        "rd",
-        "mode",
-        "evec",
-        "eval",
-        "mk",
-        "ak",
-        "rk",
-        "dt_tensor",
-        "dk_tensor",
-    ],
-)
-
-KWARGS_MAPPING = dict(
-    dwi="input_files",
-    bval="bvalues_files",
-    bvec="bvectors_files",
-    # mask="mask_files",
-    # out_metrics="save_metrics",
-)
-
-TENSOR_FITTING_CMD = "dwi2tensor {input_files} -fslgrad {bvectors_files} {bvalues_files} - | tensor2metric - -force"
-
-
-def build_tensor_fitting_cmd(kwargs, outputs):
-    cmd = TENSOR_FITTING_CMD.format(**kwargs)
+import os
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+from types import MappingProxyType
+from typing import IO, List, NamedTuple, Tuple
+
+DWI_ENTITIES = MappingProxyType(
+    dict(suffix="dwi", extension=".nii.gz", space="T1w")
+)
+
+TENSOR_DERIVED_ENTITIES = MappingProxyType(
+    dict(suffix="dwiref", resolution="dwi")
+)
+
+#: Description of the (linearly) fitted tensor coefficients' files
+TENSOR_COEFFICIENTS_DESC = "tensorCoeffs"
+
+#: Tensor-derived metrics of each tensor type (keyed by their MRtrix3
+#: options, with values of their descriptions, for "diffusion_tensor")
+TENSOR_DERIVED_METRICS = MappingProxyType(
+    dict(
+        diffusion_tensor=MappingProxyType(
+            dict(
+                fa="fa",
+                adc="md",
+                ad="ad",
+                rd="rd",
+                cl="cl",
+                cs="cs",
+                cp="cp",
+                value="evec",
+                vector="eval",
+            )
+        ),
+        restore_tensor=(
+            "fa",
+            "ga",
+            "rgb",
+            "md",
+            "ad",
+            "rd",
+            "mode",
+            "evec",
+            "eval",
+            "tensor",
+        ),
+        diffusion_kurtosis=(
+            "fa",
+            "ga",
+            "rgb",
+            "md",
+            "ad",
+            "rd",
+            "mode",
+            "evec",
+            "eval",
+            "mk",
+            "ak",
+            "rk",
+            "dt_tensor",
+            "dk_tensor",
+        ),
+    )
+)
+
+#: Tensor-derived metrics' names as sets, for (constant-time) membership tests
+TENSOR_DERIVED_METRICS_SETS = MappingProxyType(
+    {
+        tensor_type: frozenset(metrics)
+        for tensor_type, metrics in TENSOR_DERIVED_METRICS.items()
+    }
+)
+
+#: Tensor-derived metrics' names, as listed in invalid outputs' warnings
+TENSOR_DERIVED_METRICS_LISTINGS = MappingProxyType(
+    {
+        tensor_type: ", ".join(metrics)
+        for tensor_type, metrics in TENSOR_DERIVED_METRICS.items()
+    }
+)
+
+
+def build_output_description(output: str) -> str:
+    """
+    Convert a tensor-derived *output*'s name to its (camelCase) BIDS
+    description (e.g. "dt_tensor" to "dtTensor").
+
+    Parameters
+    ----------
+    output : str
+        A tensor-derived metric's name
+
+    Returns
+    -------
+    str
+        The metric's BIDS description
+    """
+    output_parts = output.split("_")
+    if len(output_parts) > 1:
+        return "".join([output_parts[0], output_parts[1].capitalize()])
+    return output
+
+
+#: BIDS descriptions of all tensor-derived metrics, by their names
+TENSOR_METRICS_DESCRIPTIONS = MappingProxyType(
+    {
+        metric: build_output_description(metric)
+        for metrics in TENSOR_DERIVED_METRICS.values()
+        for metric in metrics
+    }
+)
+
+KWARGS_MAPPING = MappingProxyType(
+    dict(
+        dwi="input_files",
+        bval="bvalues_files",
+        bvec="bvectors_files",
+        mask="mask_files",
+        # out_metrics="save_metrics",
+    )
+)
+
+#: Command lines (as argv templates) of MRtrix3's tensor fitting, piping
+#: the fitted tensor into its metrics' computation
+TENSOR_FITTING_ARGV = (
+    "dwi2tensor",
+    "{input_files}",
+    "-fslgrad",
+    "{bvectors_files}",
+    "{bvalues_files}",
+    "-",
+)
+TENSOR_METRICS_ARGV = ("tensor2metric", "-", "-force")
+
+#: MRtrix3 pipes images between commands through temporary files, which
+#: are kept in shared memory (where available) rather than on disk
+PIPE_TMPFILE_ENV = "MRTRIX_TMPFILE_DIR"
+PIPE_TMPFILE_DIR = Path("/dev/shm")
+
+#: Tensor fitting kwargs substituted into each of :data:`TENSOR_FITTING_ARGV`
+#: (None for literal arguments), parsed once rather than formatted per DWI
+TENSOR_FITTING_FIELDS = tuple(
+    arg[1:-1] if arg.startswith("{") and arg.endswith("}") else None
+    for arg in TENSOR_FITTING_ARGV
+)
+
+
+def build_tensor_fitting_cmd(
+    kwargs: dict, outputs: dict
+) -> Tuple[List[str], List[str]]:
+    """
+    Build the argv of MRtrix3's tensor fitting and metrics' commands.
+
+    Parameters
+    ----------
+    kwargs : dict
+        Tensor fitting kwargs (see :data:`KWARGS_MAPPING`)
+    outputs : dict
+        A dictionary with keys of MRtrix3's metrics' options and values of
+        their corresponding paths
+
+    Returns
+    -------
+    Tuple[List[str], List[str]]
+        argv of *dwi2tensor* and *tensor2metric*
+    """
+    fitting = [
+        str(kwargs[field]) if field else arg
+        for arg, field in zip(TENSOR_FITTING_ARGV, TENSOR_FITTING_FIELDS)
+    ]
+    metrics = list(TENSOR_METRICS_ARGV)
     for key, value in outputs.items():
-        cmd += f" -{key} {value}"
-    return cmd
+        metrics += [f"-{key}", str(value)]
+    return fitting, metrics
+
+
+class TensorFitting(NamedTuple):
+    """
+    A running MRtrix3 tensor fitting (see :func:`start_tensor_fitting`)
+    """
+
+    #: The fitted DWI
+    source: str
+    #: *dwi2tensor*'s process
+    fitting: subprocess.Popen
+    #: *tensor2metric*'s process
+    metrics: subprocess.Popen
+    #: Temporary file collecting both commands' stderr
+    log: IO[bytes]
+
+
+def start_tensor_fitting(
+    kwargs: dict, outputs: dict, n_threads: int = None
+) -> TensorFitting:
+    """
+    Start MRtrix3's tensor fitting, piping *dwi2tensor* directly (without a
+    shell) into *tensor2metric*, with the piped tensor image kept in shared
+    memory (see :data:`PIPE_TMPFILE_DIR`). Both commands' stderr is
+    collected in a temporary file, rather than interleaved with concurrent
+    fittings'.
+
+    Parameters
+    ----------
+    kwargs : dict
+        Tensor fitting kwargs (see :data:`KWARGS_MAPPING`)
+    outputs : dict
+        A dictionary with keys of MRtrix3's metrics' options and values of
+        their corresponding paths
+    n_threads : int, optional
+        Number of threads of each command, by default MRtrix3's own
+        configuration
+
+    Returns
+    -------
+    TensorFitting
+        The running fitting
+    """
+    fitting_argv, metrics_argv = build_tensor_fitting_cmd(kwargs, outputs)
+    env = dict(os.environ)
+    if n_threads:
+        env["MRTRIX_NTHREADS"] = str(n_threads)
+    if PIPE_TMPFILE_DIR.is_dir() and os.access(PIPE_TMPFILE_DIR, os.W_OK):
+        env.setdefault(PIPE_TMPFILE_ENV, str(PIPE_TMPFILE_DIR))
+    log = tempfile.TemporaryFile()
+    fitting = subprocess.Popen(
+        fitting_argv, stdout=subprocess.PIPE, stderr=log, env=env
+    )
+    try:
+        metrics = subprocess.Popen(
+            metrics_argv,
+            stdin=fitting.stdout,
+            stdout=subprocess.DEVNULL,
+            stderr=log,
+            env=env,
+        )
+    except OSError:
+        fitting.kill()
+        fitting.wait()
+        log.close()
+        raise
+    finally:
+        # Leave the pipe to tensor2metric, so that dwi2tensor gets a SIGPIPE
+        # if it exits early
+        fitting.stdout.close()
+    return TensorFitting(fitting_argv[1], fitting, metrics, log)
+
+
+def wait_tensor_fitting(pipeline: TensorFitting) -> Tuple[int, str]:
+    """
+    Wait for a tensor fitting started by :func:`start_tensor_fitting`.
+
+    Parameters
+    ----------
+    pipeline : TensorFitting
+        The running fitting
+
+    Returns
+    -------
+    Tuple[int, str]
+        The pipeline's exit code (the first non-zero one of its commands)
+        and its collected stderr
+    """
+    codes = [
+        process.wait() for process in (pipeline.fitting, pipeline.metrics)
+    ]
+    with pipeline.log as log:
+        log.seek(0)
+        stderr = log.read().decode(errors="replace")
+    return next((code for code in codes if code), 0), stderr
+
+
+def remove_outputs(outputs: dict) -> None:
+    """
+    Remove a failed fitting's (possibly partial) *outputs*, so that they are
+    not mistaken for complete ones by later runs.
+
+    Parameters
+    ----------
+    outputs : dict
+        Requested outputs as keys and their paths as values
+    """
+    for path in outputs.values():
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            continue
+
+
+#: Maximal number of (DWI, tensor type) jobs submitted to a worker at once
+JOBS_PER_BATCH = 4
+
+#: Environment variables limiting the threads of BLAS/OpenMP backends (and
+#: of MRtrix3's commands)
+BLAS_THREADS_ENVS = (
+    "OMP_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "MRTRIX_NTHREADS",
+    "NUMBA_NUM_THREADS",
+)
+
+
+def limit_blas_threads(n_threads: int = 1) -> None:
+    """
+    Limit BLAS/OpenMP (and numba) threads within a worker process, so that
+    concurrent tensor fits do not oversubscribe the available cores.
+    Explicitly configured limits are kept as are.
+
+    Parameters
+    ----------
+    n_threads : int, optional
+        Number of threads per worker, by default 1
+    """
+    n_threads = max(1, n_threads)
+    # numba reads its limit once imported (e.g. by a forking parent)
+    numba = sys.modules.get("numba")
+    if numba is not None and "NUMBA_NUM_THREADS" not in os.environ:
+        numba.set_num_threads(min(n_threads, numba.config.NUMBA_NUM_THREADS))
+    for env in BLAS_THREADS_ENVS:
+        os.environ.setdefault(env, str(n_threads))
@@ -1,12 +1,23 @@
 """
 Definition of the :class:`DataGrabber` class.
 """
+import os
+import re
+import threading
 from pathlib import Path
-from typing import Union
+from typing import Iterable, List, Tuple, Union
 
 import bids
+from bids.layout.validation import DEFAULT_LOCATIONS_TO_IGNORE
 
-from qsiprep_analyses.data.bids import BIDS_CONFIGURATION_FILE
+from qsiprep_analyses.data.bids import (
+    BIDS_CONFIGURATION_FILE,
+    compile_path_patterns,
+    freeze_query,
+    match_entities,
+    match_path_patterns,
+    parse_file_entities,
+)
 
 
 class DataGrabber:
@@ -16,29 +27,122 @@ class DataGrabber:
 
     #: Pybids configurations
     PYBIDS_CONFIG = {"qsiprep": BIDS_CONFIGURATION_FILE}
+    #: Locations left out of pybids' index (its default ones, as well as
+    #: FreeSurfer's outputs, logs and reports' figures, which are never
+    #: queried but may hold thousands of files)
+    IGNORED_LOCATIONS = (
+        *DEFAULT_LOCATIONS_TO_IGNORE,
+        re.compile(r"^/(freesurfer|logs)(/|$)"),
+        re.compile(r"/figures(/|$)"),
+    )
 
-    def __init__(self, base_dir: Path, generate_layout: bool = True) -> None:
+    #: Environment variable pointing to a persistent pybids' database
+    DATABASE_ENV = "QSIPREP_BIDS_DB"
+
+    #: Per-thread instances, as pybids' database sessions are not
+    #: thread-safe
+    _instances = threading.local()
+    #: Guards layouts' construction, which resets and extends pybids'
+    #: (process-wide) configuration
+    _layout_lock = threading.Lock()
+
+    def __init__(
+        self,
+        base_dir: Path,
+        generate_layout: bool = True,
+        database_path: Path = None,
+    ) -> None:
         self.base_dir = Path(base_dir)
+        self.database_path = database_path or os.environ.get(self.DATABASE_ENV)
+        self._subjects = None
+        self._collected = {}
+        self._subject_files = {}
+        self._queries = {}
+        self._paths = {}
+        self._gradients = {}
         if generate_layout:
             self.layout = self.get_bids_layout()
+            self.path_patterns = compile_path_patterns(
+                self.get_path_patterns()
+            )
+
+    @classmethod
+    def get_or_create(
+        cls, base_dir: Path, database_path: Path = None
+    ) -> "DataGrabber":
+        """
+        Return this thread's DataGrabber of *base_dir*, instansiating (and
+        indexing) it only on first use, so that managers instansiated
+        separately within the same thread (or worker process) share a
+        single layout. Each thread (e.g. of *parcellate_dataset*'s "threads"
+        scheduler) thus indexes *base_dir* anew, unless *database_path*
+        persists the index.
+
+        Parameters
+        ----------
+        base_dir : Path
+            A base directory of *qsiprep*'s derivatives
+        database_path : Path, optional
+            A persistent pybids' database, by default None
+
+        Returns
+        -------
+        DataGrabber
+            A shared DataGrabber instance
+        """
+        if not hasattr(cls._instances, "grabbers"):
+            cls._instances.grabbers = {}
+        database_path = database_path or os.environ.get(cls.DATABASE_ENV)
+        key = (Path(base_dir).resolve(), database_path)
+        if key not in cls._instances.grabbers:
+            cls._instances.grabbers[key] = cls(
+                base_dir, database_path=database_path
+            )
+        return cls._instances.grabbers[key]
 
     def get_bids_layout(self) -> bids.BIDSLayout:
         """
-        Return a pybids' layout of *self.base_dir*
+        Return a pybids' layout of *self.base_dir*. Where
+        *self.database_path* is set, the layout's index is loaded from (or,
+        on first use, written to) that database rather than re-indexing
+        *self.base_dir* on every instansiation.
 
         Returns
         -------
         bids.BIDSLayout
             A pybids' layout of *self.base_dir*
         """
-        bids.config.reset_options()
-        bids.layout.add_config_paths(**self.PYBIDS_CONFIG)  # pass
-        return bids.BIDSLayout(
-            self.base_dir,
-            derivatives=False,
-            validate=False,
-            config=["bids", list(self.PYBIDS_CONFIG.keys())[0]],
-        )
+        with self._layout_lock:
+            bids.config.reset_options()
+            bids.layout.add_config_paths(**self.PYBIDS_CONFIG)  # pass
+            return bids.BIDSLayout(
+                self.base_dir,
+                derivatives=False,
+                validate=False,
+                config=["bids", list(self.PYBIDS_CONFIG.keys())[0]],
+                database_path=self.database_path,
+                reset_database=False,
+                indexer=bids.BIDSLayoutIndexer(
+                    validate=False, ignore=list(self.IGNORED_LOCATIONS)
+                ),
+            )
+
+    def get_path_patterns(self) -> list:
+        """
+        Collect the default path patterns of *self.layout*'s configurations
+        once, rather than having pybids re-collect them on every
+        :meth:`build_path` call.
+
+        Returns
+        -------
+        list
+            Path patterns, in the same order of precedence pybids uses
+        """
+        path_patterns = []
+        for config in self.layout.config.values():
+            if config.default_path_patterns:
+                path_patterns.extend(config.default_path_patterns)
+        return path_patterns
 
     def query_subjects(self) -> dict:
         """
@@ -63,11 +167,138 @@ class DataGrabber:
         }
         return subjects
 
+    def collect_subjects(
+        self, participant_labels: Iterable[str] = None
+    ) -> dict:
+        """
+        Collect available sessions for *participant_labels*, memoized per
+        labels' set, as managers sharing this DataGrabber collect the same
+        subjects.
+
+        Parameters
+        ----------
+        participant_labels : Iterable[str], optional
+            Specific participants' labels to be queried, by default None (all
+            available participants)
+
+        Returns
+        -------
+        dict
+            A (shallow) copy of the participants' sessions, keyed by their
+            labels
+        """
+        key = frozenset(participant_labels or ())
+        if key not in self._collected:
+            self._collected[key] = (
+                {
+                    participant_label: self.subjects.get(participant_label)
+                    for participant_label in sorted(key)
+                }
+                if key
+                else self.subjects
+            )
+        return dict(self._collected[key])
+
+    def get_subject_files(self, participant_label: str) -> List[tuple]:
+        """
+        Index all of *participant_label*'s files and their entities once,
+        so that subsequent queries only filter this (much smaller) index.
+
+        Parameters
+        ----------
+        participant_label : str
+            Specific participant's label
+
+        Returns
+        -------
+        List[tuple]
+            A list of (path, entities) tuples for all participant's files
+        """
+        if participant_label not in self._subject_files:
+            self._subject_files[participant_label] = [
+                (Path(bids_file.path), bids_file.get_entities())
+                for bids_file in self.layout.get(subject=participant_label)
+            ]
+        return self._subject_files.get(participant_label)
+
+    def index_subjects(self, participant_labels: Iterable[str]) -> None:
+        """
+        Index all of *participant_labels*' files (see
+        :meth:`get_subject_files`) with a single layout query, rather than
+        one per participant.
+
+        Parameters
+        ----------
+        participant_labels : Iterable[str]
+            Specific participants' labels
+        """
+        pending = sorted(set(participant_labels) - set(self._subject_files))
+        if not pending:
+            return
+        index = {participant_label: [] for participant_label in pending}
+        for bids_file in self.layout.get(subject=pending):
+            entities = bids_file.get_entities()
+            index[entities.get("subject")].append(
+                (Path(bids_file.path), entities)
+            )
+        self._subject_files.update(index)
+
+    def query(self, query: dict) -> Tuple[Path]:
+        """
+        Locate files matching a bids *query*, memoizing results per query so
+        that managers sharing this DataGrabber also share their lookups.
+
+        Parameters
+        ----------
+        query : dict
+            A bids query (entities as keys)
+
+        Returns
+        -------
+        Tuple[Path]
+            Paths to all files matching *query*
+        """
+        key = freeze_query(query)
+        if key not in self._queries:
+            self._queries[key] = self.search(query)
+        return self._queries[key]
+
+    def search(self, query: dict) -> Tuple[Path]:
+        """
+        Locate files matching a bids *query*, using the participant's index
+        where the query targets a single participant.
+
+        Parameters
+        ----------
+        query : dict
+            A bids query (entities as keys)
+
+        Returns
+        -------
+        Tuple[Path]
+            Paths to all files matching *query*
+        """
+        participant_label = query.get("subject")
+        if not isinstance(participant_label, str):
+            return tuple(
+                Path(result.path) for result in self.layout.get(**query)
+            )
+        filters = {
+            key: value for key, value in query.items() if key != "subject"
+        }
+        return tuple(
+            path
+            for path, entities in self.get_subject_files(participant_label)
+            if match_entities(entities, filters)
+        )
+
     def build_path(
         self, source: Union[dict, str, Path], replacements: dict
     ) -> Path:
         """
-        Build a BIDS-compatible path according to source file/entities.
+        Build a BIDS-compatible path according to source file/entities,
+        memoized per (source, replacements), as identical output paths are
+        requested repeatedly (e.g. expected outputs and their generation).
 
         Parameters
         ----------
@@ -83,18 +314,62 @@ class DataGrabber:
         Path
             Path to BIDS-compatible path
         """
-        if isinstance(source, (str, Path)):
-            source = bids.layout.parse_file_entities(source)
-        for key, value in replacements.items():
-            source[key] = value
-        return Path(
-            self.layout.build_path(
-                source,
-                validate=False,
-                strict=True,
-            )
+        key = (
+            str(source)
+            if isinstance(source, (str, Path))
+            else freeze_query(source),
+            freeze_query(replacements),
         )
+        if key not in self._paths:
+            if isinstance(source, (str, Path)):
+                source = parse_file_entities(source)
+            entities = dict(source, **replacements)
+            self._paths[key] = Path(
+                self.layout.build_path(
+                    entities,
+                    path_patterns=match_path_patterns(
+                        entities, self.path_patterns
+                    ),
+                    validate=False,
+                    strict=True,
+                )
+            )
+        return self._paths[key]
+
+    def get_gradients(self, dwi: str) -> dict:
+        """
+        Locate a DWI's gradients (.bval and .bvec), which *qsiprep* writes
+        alongside it, falling back to pybids' (nearest-file) search only
+        where no such sibling exists. Memoized per DWI, as managers sharing
+        this DataGrabber query the same DWIs under different queries.
+
+        Parameters
+        ----------
+        dwi : str
+            Path to a preprocessed DWI
+
+        Returns
+        -------
+        dict
+            A dictionary with keys of ["bval","bvec"]
+        """
+        if dwi not in self._gradients:
+            extension = parse_file_entities(dwi).get("extension", "")
+            stem = dwi[: -len(extension)] if extension else dwi
+            gradients = {}
+            for key, fallback in [
+                ("bval", self.layout.get_bval),
+                ("bvec", self.layout.get_bvec),
+            ]:
+                sibling = Path(f"{stem}.{key}")
+                gradients[key] = (
+                    str(sibling) if sibling.exists() else fallback(dwi)
+                )
+            self._gradients[dwi] = gradients
+        return dict(self._gradients[dwi])
 
     @property
     def subjects(self) -> dict:
-        return self.query_subjects()
+        if self._subjects is None:
+            self._subjects = self.query_subjects()
+        return self._subjects
@@ -0,0 +1,161 @@
+"""
+Image loading utilities.
+"""
+import os
+import queue
+import threading
+from pathlib import Path
+from typing import Iterable, Iterator, Tuple, Union
+
+import nibabel as nib
+import numpy as np
+
+#: Number of volumes to be read ahead of their consumption
+PREFETCH_ENV = "QSIPREP_PREFETCH"
+DEFAULT_PREFETCH = 2
+
+
+def load_volume(
+    path: Union[Path, str], dtype: np.dtype = np.float32
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Load an image's data through its (lazy) array proxy, casting directly to
+    *dtype* rather than materializing a float64 volume with *get_fdata*.
+
+    Parameters
+    ----------
+    path : Union[Path, str]
+        Path to a NIfTI image
+    dtype : np.dtype, optional
+        Target data type, by default np.float32
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        The image's data and affine
+    """
+    img = nib.load(str(path))
+    return np.asarray(img.dataobj, dtype=dtype), img.affine
+
+
+def load_labels(path: Union[Path, str]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Load a parcellation image with the smallest integer data type that fits
+    its labels, reading integer images in their on-disk data type rather
+    than through a float64 copy.
+
+    Parameters
+    ----------
+    path : Union[Path, str]
+        Path to a parcellation (labels) image
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        The image's labels and affine
+    """
+    img = nib.load(str(path))
+    labels, affine = np.asanyarray(img.dataobj), img.affine
+    del img
+    if not np.issubdtype(labels.dtype, np.integer):
+        # Only scaled or floating-point images need rounding (np.rint would
+        # otherwise promote integer labels to float64).
+        labels = np.rint(labels)
+    if labels.size and labels.min() < 0:
+        dtype = np.int32
+    else:
+        dtype = np.min_scalar_type(int(labels.max()) if labels.size else 0)
+    return labels.astype(dtype, copy=False), affine
+
+
+def save_labels(
+    labels: np.ndarray, affine: np.ndarray, path: Union[Path, str]
+) -> Path:
+    """
+    Save a parcellation image in its labels' (narrow) integer data type.
+    Gzipped outputs use nibabel's default compression level (1), which is
+    much cheaper than zlib's default (6) for nearly the same size.
+
+    Parameters
+    ----------
+    labels : np.ndarray
+        An integer parcellation image
+    affine : np.ndarray
+        The image's affine
+    path : Union[Path, str]
+        Output path
+
+    Returns
+    -------
+    Path
+        Path to the saved image
+    """
+    img = nib.Nifti1Image(labels, affine)
+    img.set_data_dtype(labels.dtype)
+    nib.save(img, str(path))
+    return Path(path)
+
+
+def _put(buffer: queue.Queue, item: tuple, stop: threading.Event) -> None:
+    while not stop.is_set():
+        try:
+            return buffer.put(item, timeout=0.1)
+        except queue.Full:
+            continue
+
+
+def _read_ahead(
+    paths: list, buffer: queue.Queue, stop: threading.Event, dtype: np.dtype
+) -> None:
+    for path in paths:
+        try:
+            item = (path, load_volume(path, dtype)[0])
+        except Exception as error:  # re-raised by the consumer
+            item = (path, error)
+        _put(buffer, item, stop)
+        if stop.is_set() or isinstance(item[1], Exception):
+            return
+
+
+def prefetch_volumes(
+    paths: Iterable[Union[Path, str]],
+    depth: int = None,
+    dtype: np.dtype = np.float32,
+) -> Iterator[Tuple[Union[Path, str], np.ndarray]]:
+    """
+    Iterate over images' data, while a background thread reads up to
+    *depth* upcoming images, so that reading (from possibly networked
+    storage) overlaps the consumer's computations.
+
+    Parameters
+    ----------
+    paths : Iterable[Union[Path, str]]
+        Paths to NIfTI images, in order of consumption
+    depth : int, optional
+        Number of images to read ahead, by default taken from the
+        *QSIPREP_PREFETCH* environment variable (or 2)
+    dtype : np.dtype, optional
+        Target data type, by default np.float32
+
+    Yields
+    ------
+    Tuple[Union[Path, str], np.ndarray]
+        Each path and its image's data
+    """
+    paths = list(paths)
+    depth = depth or int(os.environ.get(PREFETCH_ENV, DEFAULT_PREFETCH))
+    buffer = queue.Queue(maxsize=max(1, depth))
+    stop = threading.Event()
+    reader = threading.Thread(
+        target=_read_ahead, args=(paths, buffer, stop, dtype), daemon=True
+    )
+    reader.start()
+    try:
+        for _ in paths:
+            path, data = buffer.get()
+            if isinstance(data, Exception):
+                raise data
+            yield path, data
+    finally:
+        stop.set()
+        reader.join()
@@ -1,5 +1,9 @@
+import os
+from concurrent.futures import Future, as_completed
 from pathlib import Path
-from typing import Union
+from typing import Iterable, Iterator, Union
+
+from tqdm import tqdm
 
 from qsiprep_analyses.utils.data_grabber import DataGrabber
 from qsiprep_analyses.utils.messages import MISSING_DATAGRABBER
@@ -12,10 +16,13 @@ def validate_instantiation(
 ) -> DataGrabber:
     """
     Validates the instansitation of *NativeParcellation* object with base
-    directory or DataGrabber instance.
+    directory or DataGrabber instance. An already instansiated DataGrabber
+    takes precedence, so that managers may share a single (indexed) layout.
 
     Parameters
     ----------
+    instance : object
+        The object being instansiated
     base_dir : Path, optional
         A base directory of *qsiprep*'s derivatives, by default None
     data_grabber : DataGrabber, optional
@@ -30,8 +37,10 @@ def validate_instantiation(
     if isinstance(data_grabber, DataGrabber):
         return data_grabber
     if base_dir:
-        return DataGrabber(base_dir)
-    raise ValueError(MISSING_DATAGRABBER.format(object_name=instance.__name__))
+        return DataGrabber.get_or_create(base_dir)
+    raise ValueError(
+        MISSING_DATAGRABBER.format(object_name=type(instance).__name__)
+    )
 
 
 def collect_subjects(
@@ -39,10 +48,14 @@ def collect_subjects(
     participant_labels: Union[str, list] = None,
 ) -> dict:
     """
-    Queries available sessions for *participant_labels*.
+    Queries available sessions for *participant_labels*. Results are memoized
+    by the instance's DataGrabber (see :meth:`DataGrabber.collect_subjects`),
+    so that managers sharing it do not re-collect the same subjects.
 
     Parameters
     ----------
+    instance : object
+        A manager, holding a *data_grabber* to query
     participant_labels : Union[str, List], optional
         Specific participants' labels to be queried, by default None
 
@@ -52,17 +65,9 @@ def collect_subjects(
         A dictionary with participant labels as keys and available
          sessions as values
     """
-    if not participant_labels:
-        return instance.data_grabber.subjects
-
     if isinstance(participant_labels, str):
         participant_labels = [participant_labels]
-    return {
-        participant_label: instance.data_grabber.subjects.get(
-            participant_label
-        )
-        for participant_label in participant_labels
-    }
+    return instance.data_grabber.collect_subjects(participant_labels)
 
 
 def apply_bids_filters(original: dict, replacements: dict) -> dict:
@@ -86,3 +91,58 @@ def apply_bids_filters(original: dict, replacements: dict) -> dict:
         for key, value in replacements.items():
             combined_filters[key] = value
     return combined_filters
+
+
+def iterate_completed(futures: dict) -> Iterator[Future]:
+    """
+    Iterate over *futures* as they complete, with a progress bar that is
+    refreshed in batches (rather than on every completion), so that
+    quickly completing workers do not serialize on the terminal.
+
+    Parameters
+    ----------
+    futures : dict
+        Submitted futures (as keys)
+
+    Returns
+    -------
+    Iterator[Future]
+        Completed futures
+    """
+    return tqdm(
+        as_completed(futures),
+        total=len(futures),
+        miniters=max(1, len(futures) // 100),
+        mininterval=1.0,
+        smoothing=0,
+    )
+
+
+def all_exist(paths: Iterable[Path]) -> bool:
+    """
+    Check whether all *paths* exist, scanning each of their parent
+    directories once (rather than stat-ing every path) and stopping at the
+    first missing one.
+
+    Parameters
+    ----------
+    paths : Iterable[Path]
+        Paths to check
+
+    Returns
+    -------
+    bool
+        Whether all of *paths* exist
+    """
+    listings = {}
+    for path in map(Path, paths):
+        parent = path.parent
+        if parent not in listings:
+            try:
+                with os.scandir(parent) as entries:
+                    listings[parent] = {entry.name for entry in entries}
+            except OSError:
+                return False
+        if path.name not in listings[parent]:
+            return False
+    return True
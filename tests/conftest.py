@@ -0,0 +1,53 @@
+import nibabel as nib
+import numpy as np
+import pytest
+from dipy.core.gradients import gradient_table
+from dipy.reconst import dti
+
+#: A single DWI's location within a *qsiprep* derivatives' tree
+DWI_PREFIX = "sub-01/ses-1/dwi/sub-01_ses-1_space-T1w"
+
+
+@pytest.fixture
+def qsiprep_dir(tmp_path):
+    """
+    A *qsiprep* derivatives' tree holding a single (noisy) DWI of random
+    diffusion tensors, along with its gradients and brain mask.
+    """
+    (tmp_path / "dataset_description.json").write_text(
+        '{"Name": "qsiprep", "BIDSVersion": "1.6.0", '
+        '"DatasetType": "derivative"}'
+    )
+    prefix = tmp_path / DWI_PREFIX
+    prefix.parent.mkdir(parents=True)
+    rng = np.random.default_rng(0)
+    bvals = np.repeat([0, 1000], [3, 30])
+    bvecs = rng.normal(size=(len(bvals), 3))
+    bvecs /= np.linalg.norm(bvecs, axis=1, keepdims=True)
+    bvecs[bvals == 0] = 0
+    np.savetxt(f"{prefix}_desc-preproc_dwi.bval", bvals[None], fmt="%d")
+    np.savetxt(f"{prefix}_desc-preproc_dwi.bvec", bvecs.T)
+    shape = (4, 5, 6)
+    n_voxels = int(np.prod(shape))
+    evals = rng.uniform(2e-4, 2e-3, size=(n_voxels, 3))
+    evecs = np.linalg.qr(rng.normal(size=(n_voxels, 3, 3)))[0]
+    params = np.concatenate(
+        [
+            dti.lower_triangular(dti.vec_val_vect(evecs, evals)),
+            np.full((n_voxels, 1), -np.log(1000)),
+        ],
+        axis=1,
+    )
+    design = dti.design_matrix(gradient_table(bvals, bvecs=bvecs))
+    signal = np.exp(params @ design.T)
+    signal += rng.normal(scale=10, size=signal.shape)
+    signal = np.abs(signal).reshape(shape + (-1,)).astype(np.float32)
+    nib.save(
+        nib.Nifti1Image(signal, np.eye(4)),
+        f"{prefix}_desc-preproc_dwi.nii.gz",
+    )
+    nib.save(
+        nib.Nifti1Image(np.ones(shape, dtype=np.uint8), np.eye(4)),
+        f"{prefix}_desc-brain_mask.nii.gz",
+    )
+    return tmp_path
@@ -0,0 +1,105 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import bids
+import pytest
+
+from qsiprep_analyses.data.bids import match_entities, match_path_patterns
+from qsiprep_analyses.utils.data_grabber import DataGrabber
+
+#: A minimal *qsiprep* derivatives' tree (as empty files)
+FILES = [
+    "sub-01/anat/sub-01_desc-preproc_T1w.nii.gz",
+    "sub-01/anat/sub-01_desc-brain_mask.nii.gz",
+    "sub-01/anat/sub-01_from-MNI152NLin2009cAsym_to-T1w_mode-image_xfm.h5",
+    "sub-01/ses-1/dwi/sub-01_ses-1_space-T1w_desc-preproc_dwi.nii.gz",
+    "sub-01/ses-1/dwi/sub-01_ses-1_space-T1w_desc-preproc_dwi.bval",
+    "sub-01/ses-1/dwi/sub-01_ses-1_space-T1w_desc-preproc_dwi.bvec",
+    "sub-01/ses-1/dwi/sub-01_ses-1_space-T1w_desc-brain_mask.nii.gz",
+    "sub-01/ses-2/dwi/sub-01_ses-2_space-T1w_desc-preproc_dwi.nii.gz",
+    "sub-01/ses-2/dwi/sub-01_ses-2_space-T1w_desc-eddy_dwi.nii.gz",
+]
+
+QUERIES = [
+    dict(suffix="dwi", extension=".nii.gz"),
+    dict(suffix="dwi", extension="nii.gz", session="2"),
+    dict(suffix="mask", space=None),
+    dict(suffix="mask", space="T1w", datatype="dwi"),
+    dict(desc=["preproc", "eddy"], session=["1", "2"], suffix="dwi"),
+    dict(suffix="xfm", **{"from": "MNI152NLin2009cAsym"}),
+    dict(extension=[".bval", ".bvec"]),
+]
+
+
+@pytest.fixture(scope="module")
+def data_grabber(tmp_path_factory):
+    base_dir = tmp_path_factory.mktemp("qsiprep")
+    (base_dir / "dataset_description.json").write_text(
+        '{"Name": "qsiprep", "BIDSVersion": "1.6.0", '
+        '"DatasetType": "derivative"}'
+    )
+    for path in FILES:
+        (base_dir / path).parent.mkdir(parents=True, exist_ok=True)
+        (base_dir / path).touch()
+    return DataGrabber(base_dir)
+
+
+@pytest.mark.parametrize("query", QUERIES)
+def test_match_entities_matches_layout(data_grabber, query):
+    matched = {
+        path
+        for path, entities in data_grabber.get_subject_files("01")
+        if match_entities(entities, query)
+    }
+    expected = {
+        bids_file.path
+        for bids_file in data_grabber.layout.get(subject="01", **query)
+    }
+    assert expected
+    assert {str(path) for path in matched} == expected
+
+
+@pytest.mark.parametrize(
+    "replacements",
+    [
+        dict(acquisition="dt", desc="fa", suffix="dwiref"),
+        dict(desc="tensorCoeffs", resolution="dwi", suffix="dwiref"),
+    ],
+)
+def test_match_path_patterns_matches_layout(data_grabber, replacements):
+    source = FILES[3]
+    entities = dict(bids.layout.parse_file_entities(source), **replacements)
+    patterns = match_path_patterns(entities, data_grabber.path_patterns)
+    built = data_grabber.layout.build_path(
+        entities, path_patterns=patterns, validate=False, strict=True
+    )
+    assert built is not None
+    assert built == data_grabber.layout.build_path(
+        entities, validate=False, strict=True
+    )
+
+
+def test_layouts_built_one_at_a_time(data_grabber, monkeypatch):
+    building, concurrency = [], []
+    build_layout = bids.BIDSLayout
+
+    def slow_build_layout(*args, **kwargs):
+        building.append(None)
+        concurrency.append(len(building))
+        time.sleep(0.05)
+        try:
+            return build_layout(*args, **kwargs)
+        finally:
+            building.pop()
+
+    monkeypatch.setattr(bids, "BIDSLayout", slow_build_layout)
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        grabbers = list(
+            executor.map(
+                lambda _: DataGrabber(data_grabber.base_dir), range(4)
+            )
+        )
+    assert max(concurrency) == 1
+    expected = sorted(data_grabber.layout.get(return_type="filename"))
+    for grabber in grabbers:
+        assert sorted(grabber.layout.get(return_type="filename")) == expected
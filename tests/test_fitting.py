@@ -0,0 +1,175 @@
+import os
+
+import nibabel as nib
+import numpy as np
+import pytest
+from dipy.core.gradients import gradient_table
+from dipy.reconst import dki, dti
+
+from qsiprep_analyses.tensors import fitting
+from qsiprep_analyses.tensors.fitting import estimate_kurtosis, estimate_tensor
+
+#: Phantom's shape and (unweighted) signal
+SHAPE = (4, 5, 6)
+S0 = 1000
+
+
+def build_gradients(tmp_path, bvals):
+    rng = np.random.default_rng(0)
+    bvecs = rng.normal(size=(len(bvals), 3))
+    bvecs /= np.linalg.norm(bvecs, axis=1, keepdims=True)
+    bvecs[bvals == 0] = 0
+    np.savetxt(tmp_path / "dwi.bval", bvals[None], fmt="%d")
+    np.savetxt(tmp_path / "dwi.bvec", bvecs.T)
+    return gradient_table(bvals, bvecs=bvecs)
+
+
+def build_phantom(tmp_path, gtab, model):
+    """
+    Simulate a (noisy) DWI of random diffusion (and kurtosis) tensors.
+    """
+    rng = np.random.default_rng(1)
+    n_voxels = int(np.prod(SHAPE))
+    evals = rng.uniform(2e-4, 2e-3, size=(n_voxels, 3))
+    evecs = np.linalg.qr(rng.normal(size=(n_voxels, 3, 3)))[0]
+    tensor = dti.lower_triangular(dti.vec_val_vect(evecs, evals))
+    # dipy's design matrices hold -1 for the (log) S0 coefficient
+    params = [tensor, np.full((n_voxels, 1), -np.log(S0))]
+    if model is dki:
+        md = evals.mean(axis=1, keepdims=True)
+        kurtosis = rng.uniform(0, 1, size=(n_voxels, 15))
+        params.insert(1, kurtosis * md**2)
+    params = np.concatenate(params, axis=1)
+    design = model.design_matrix(gtab)
+    signal = np.exp(params @ design.T)
+    signal += rng.normal(scale=S0 / 100, size=signal.shape)
+    signal = np.abs(signal).reshape(SHAPE + (-1,)).astype(np.float32)
+    nib.save(nib.Nifti1Image(signal, np.eye(4)), tmp_path / "dwi.nii.gz")
+    return signal
+
+
+def load_outputs(outputs):
+    return {
+        key.replace("out_", "", 1): nib.load(path).get_fdata()
+        for key, path in outputs.items()
+    }
+
+
+@pytest.mark.parametrize("fit_method", ["WLS", "OLS"])
+def test_estimate_tensor_matches_dipy(tmp_path, fit_method):
+    bvals = np.repeat([0, 1000], [3, 30])
+    gtab = build_gradients(tmp_path, bvals)
+    signal = build_phantom(tmp_path, gtab, dti)
+    outputs = {
+        f"out_{metric}": str(tmp_path / f"{metric}.nii.gz")
+        for metric in ["fa", "md", "ad", "rd"]
+    }
+    estimate_tensor(
+        str(tmp_path / "dwi.nii.gz"),
+        str(tmp_path / "dwi.bval"),
+        str(tmp_path / "dwi.bvec"),
+        outputs,
+        fit_method=fit_method,
+    )
+    fit = dti.TensorModel(gtab, fit_method=fit_method).fit(signal)
+    expected = dict(fa=fit.fa, md=fit.md, ad=fit.ad, rd=fit.rd)
+    for metric, values in load_outputs(outputs).items():
+        np.testing.assert_allclose(
+            values, expected[metric], rtol=1e-3, atol=1e-6, err_msg=metric
+        )
+
+
+@pytest.mark.parametrize("fit_method", ["WLS", "OLS"])
+def test_estimate_kurtosis_matches_dipy(tmp_path, fit_method):
+    bvals = np.repeat([0, 1000, 2000], [3, 30, 30])
+    gtab = build_gradients(tmp_path, bvals)
+    signal = build_phantom(tmp_path, gtab, dki)
+    outputs = {
+        f"out_{metric}": str(tmp_path / f"{metric}.nii.gz")
+        for metric in ["fa", "md", "mk", "ak", "rk"]
+    }
+    estimate_kurtosis(
+        str(tmp_path / "dwi.nii.gz"),
+        str(tmp_path / "dwi.bval"),
+        str(tmp_path / "dwi.bvec"),
+        outputs,
+        fit_method=fit_method,
+    )
+    fit = dki.DiffusionKurtosisModel(gtab, fit_method=fit_method).fit(signal)
+    expected = dict(
+        fa=fit.fa,
+        md=fit.md,
+        mk=fit.mk(max_kurtosis=10),
+        ak=fit.ak(max_kurtosis=10),
+        rk=fit.rk(max_kurtosis=10),
+    )
+    for metric, values in load_outputs(outputs).items():
+        np.testing.assert_allclose(
+            values, expected[metric], rtol=1e-2, atol=1e-4, err_msg=metric
+        )
+
+
+@pytest.mark.parametrize("source", ["dwi.bval", "dwi.bvec", "mask.nii.gz"])
+def test_coefficients_refitted_after_inputs(tmp_path, monkeypatch, source):
+    bvals = np.repeat([0, 1000], [3, 30])
+    gtab = build_gradients(tmp_path, bvals)
+    build_phantom(tmp_path, gtab, dti)
+    mask = np.ones(SHAPE, dtype=np.uint8)
+    nib.save(nib.Nifti1Image(mask, np.eye(4)), tmp_path / "mask.nii.gz")
+    fits = []
+    fit_tensor_masked = fitting._fit_tensor_masked
+    monkeypatch.setattr(
+        fitting,
+        "_fit_tensor_masked",
+        lambda *args: fits.append(args) or fit_tensor_masked(*args),
+    )
+    arguments = dict(
+        dwi=str(tmp_path / "dwi.nii.gz"),
+        bval=str(tmp_path / "dwi.bval"),
+        bvec=str(tmp_path / "dwi.bvec"),
+        outputs={"out_fa": str(tmp_path / "fa.nii.gz")},
+        mask=str(tmp_path / "mask.nii.gz"),
+        coefficients=str(tmp_path / "coefficients.nii.gz"),
+    )
+    estimate_tensor(**arguments)
+    estimate_tensor(**arguments)
+    assert len(fits) == 1
+    stamp = os.stat(arguments["coefficients"]).st_mtime + 10
+    os.utime(tmp_path / source, (stamp, stamp))
+    estimate_tensor(**arguments)
+    assert len(fits) == 2
+
+
+def test_coefficients_preserve_fit(tmp_path):
+    bvals = np.repeat([0, 1000], [3, 30])
+    gtab = build_gradients(tmp_path, bvals)
+    build_phantom(tmp_path, gtab, dti)
+    mask = np.ones(SHAPE, dtype=np.uint8)
+    mask[0] = 0
+    nib.save(nib.Nifti1Image(mask, np.eye(4)), tmp_path / "mask.nii.gz")
+    arguments = dict(
+        dwi=str(tmp_path / "dwi.nii.gz"),
+        bval=str(tmp_path / "dwi.bval"),
+        bvec=str(tmp_path / "dwi.bvec"),
+        mask=str(tmp_path / "mask.nii.gz"),
+    )
+    metrics = ["md", "eval"]
+    runs = {}
+    for run, coefficients in [
+        ("uncached", None),
+        ("fitted", tmp_path / "coefficients.nii.gz"),
+        ("loaded", tmp_path / "coefficients.nii.gz"),
+    ]:
+        outputs = {
+            f"out_{metric}": str(tmp_path / f"{run}_{metric}.nii.gz")
+            for metric in metrics
+        }
+        estimate_tensor(
+            **arguments, outputs=outputs, coefficients=coefficients
+        )
+        runs[run] = load_outputs(outputs)
+    for run in ["fitted", "loaded"]:
+        for metric in metrics:
+            np.testing.assert_array_equal(
+                runs[run][metric], runs["uncached"][metric]
+            )
@@ -0,0 +1,54 @@
+import pandas as pd
+import pytest
+
+pytest.importorskip("brain_parts")
+
+from qsiprep_analyses.parcellations.parcellations import (  # noqa: E402
+    NativeParcellation,
+)
+
+
+def test_sessions_without_tensors_raise(qsiprep_dir, monkeypatch):
+    parcellation = NativeParcellation(qsiprep_dir)
+    # The session's only tensor fitting failed (see
+    # test_tensor_estimation_mrtrix.test_failed_fit_is_left_out)
+    monkeypatch.setattr(
+        parcellation.tensor_estimation,
+        "run_single_subject",
+        lambda *args, **kwargs: {"1": {"diffusion_tensor": []}},
+    )
+    monkeypatch.setattr(
+        parcellation.registration_manager,
+        "run_single_subject",
+        lambda *args, **kwargs: {"1": {"whole_brain": None}},
+    )
+    with pytest.raises(FileNotFoundError, match="diffusion_tensor"):
+        parcellation.parcellate_sessions(
+            "brainnetome",
+            "diffusion_tensor",
+            "01",
+            "whole_brain",
+            rows=pd.MultiIndex.from_tuples([("01", "1")]),
+            sessions=["1"],
+        )
+
+
+@pytest.mark.parametrize(
+    "kwargs", [dict(), dict(n_jobs=1), dict(scheduler="processes", n_jobs=1)]
+)
+def test_parcellate_dataset_runs_in_process(qsiprep_dir, monkeypatch, kwargs):
+    parcellation = NativeParcellation(qsiprep_dir)
+    subject = pd.DataFrame(
+        [[0.5]],
+        index=pd.MultiIndex.from_tuples(
+            [("01", "1", "fa")], names=NativeParcellation.ROWS_NAMES
+        ),
+    )
+    # A (non-picklable) stand-in, only reachable within this process
+    monkeypatch.setattr(
+        parcellation,
+        "parcellate_single_subject",
+        lambda participant_label, **kwargs: subject,
+    )
+    data = parcellation.parcellate_dataset("brainnetome", **kwargs)
+    pd.testing.assert_frame_equal(data, subject)
@@ -0,0 +1,49 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from qsiprep_analyses.parcellations.utils import (
+    ATLAS_LABEL_COLUMN,
+    align_to_atlas,
+    index_labels,
+    read_table,
+    reduce_by_label,
+    write_table,
+)
+
+
+@pytest.mark.parametrize("measure", [np.nanmean, np.nansum, np.nanstd])
+def test_reduce_by_label_matches_loop(measure):
+    rng = np.random.default_rng(0)
+    labels = rng.choice([0, 1, 2, 5, 40], size=(6, 7, 8)).astype(np.int16)
+    data = rng.normal(size=labels.shape)
+    data[rng.random(size=labels.shape) < 0.1] = np.nan
+    unique, values = reduce_by_label(data, index_labels(labels), measure)
+    np.testing.assert_array_equal(unique, [1, 2, 5, 40])
+    expected = [measure(data[labels == label]) for label in unique]
+    np.testing.assert_allclose(values, expected)
+
+
+def test_align_to_atlas_keeps_missing_parcels():
+    parcels = pd.DataFrame(
+        {ATLAS_LABEL_COLUMN: [1, 2, 5, 40, 41]}, index=list("abcde")
+    )
+    labels = np.array([[[0, 1], [5, 41]]], dtype=np.int16)
+    data = np.array([[[9.0, 1.0], [5.0, 4.0]]])
+    unique, values = reduce_by_label(data, index_labels(labels))
+    aligned = align_to_atlas(unique, values, parcels, name="fa")
+    expected = pd.Series([1.0, np.nan, 5.0, np.nan, 4.0], index=list("abcde"))
+    pd.testing.assert_series_equal(aligned, expected.rename("fa"))
+
+
+def test_table_round_trip(tmp_path):
+    columns = pd.MultiIndex.from_product([["fa", "md"], [1, 2, 35]])
+    index = pd.MultiIndex.from_tuples(
+        [("01", "1"), ("01", "2")], names=["subject", "session"]
+    )
+    data = pd.DataFrame(
+        np.arange(12, dtype=float).reshape(2, 6), index=index, columns=columns
+    )
+    path = tmp_path / "table.parquet"
+    write_table(data, path)
+    pd.testing.assert_frame_equal(read_table(path), data)
@@ -0,0 +1,14 @@
+import pytest
+
+pytest.importorskip("brain_parts")
+
+from qsiprep_analyses.registrations.registrations import (  # noqa: E402
+    NativeRegistration,
+)
+
+
+def test_missing_anatomical_reference_raises(qsiprep_dir):
+    # The tree holds no (preprocessed) T1w to register to
+    registration = NativeRegistration(qsiprep_dir)
+    with pytest.raises(FileNotFoundError, match="reference"):
+        registration.register_to_anatomical("brainnetome", "01")
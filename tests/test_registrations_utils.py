@@ -0,0 +1,44 @@
+import nibabel as nib
+import numpy as np
+import pytest
+from nibabel.processing import resample_from_to
+
+from qsiprep_analyses.registrations.utils import (
+    apply_coordinates_lut,
+    build_coordinates_lut,
+)
+
+
+@pytest.mark.parametrize(
+    "reference_affine",
+    [
+        np.diag([2.0, 2.0, 2.0, 1.0]),
+        np.array(
+            [
+                [1.5, 0.2, 0.0, -3.13],
+                [-0.1, 1.7, 0.3, 2.27],
+                [0.0, -0.2, 1.6, 1.31],
+                [0.0, 0.0, 0.0, 1.0],
+            ]
+        ),
+    ],
+)
+def test_coordinates_lut_matches_resampling(reference_affine):
+    # Affines are chosen so that no voxel falls exactly halfway between two
+    # source voxels, where rounding conventions differ
+    rng = np.random.default_rng(0)
+    labels = rng.integers(0, 50, size=(10, 11, 12), dtype=np.int16)
+    source_affine = np.diag([1.1, 1.0, 0.9, 1.0])
+    source_affine[:3, 3] = [-2.0, 1.0, 0.5]
+    reference_shape = (7, 8, 9)
+    lut = build_coordinates_lut(
+        source_affine, labels.shape, reference_affine, reference_shape
+    )
+    resampled = apply_coordinates_lut(labels, lut)
+    expected = resample_from_to(
+        nib.Nifti1Image(labels, source_affine),
+        (reference_shape, reference_affine),
+        order=0,
+    ).get_fdata()
+    assert resampled.dtype == labels.dtype
+    np.testing.assert_array_equal(resampled, expected)
@@ -0,0 +1,30 @@
+from pathlib import Path
+
+import nibabel as nib
+import numpy as np
+from dipy.core.gradients import gradient_table
+from dipy.reconst import dti
+
+from qsiprep_analyses.tensors.tensor_estimation import TensorEstimation
+
+
+def test_restore_saves_requested_metrics(qsiprep_dir, monkeypatch):
+    # dipy's workflows write their default outputs to the working directory
+    monkeypatch.chdir(qsiprep_dir)
+    inputs = set(qsiprep_dir.rglob("*.nii.gz"))
+    outputs = TensorEstimation(qsiprep_dir).run_single_subject(
+        "01", tensor_type="restore_tensor", out_metrics=["fa", "md"]
+    )
+    (restore,) = outputs["1"]["restore_tensor"]
+    assert set(restore) == {"out_fa", "out_md"}
+    written = set(qsiprep_dir.rglob("*.nii.gz")) - inputs
+    assert written == {Path(path) for path in restore.values()}
+    (dwi,) = qsiprep_dir.rglob("*_dwi.nii.gz")
+    prefix = str(dwi).replace(".nii.gz", "")
+    gtab = gradient_table(
+        np.loadtxt(f"{prefix}.bval"), bvecs=np.loadtxt(f"{prefix}.bvec").T
+    )
+    fit = dti.TensorModel(gtab).fit(nib.load(dwi).get_fdata())
+    np.testing.assert_allclose(
+        nib.load(restore["out_fa"]).get_fdata(), fit.fa, atol=1e-2
+    )
@@ -0,0 +1,35 @@
+import os
+
+import pytest
+
+from qsiprep_analyses.tensors.tensor_estimation_mrtrix import TensorEstimation
+
+#: Stand-ins for MRtrix3's executables, with a failing tensor fit whose
+#: metrics are (partially) written nevertheless
+FAILING_MRTRIX = dict(
+    dwi2tensor='#!/bin/sh\necho "dwi2tensor: failed" >&2\nexit 3\n',
+    tensor2metric=(
+        "#!/bin/sh\ncat > /dev/null\n"
+        'for arg in "$@"; do case "$arg" in *.nii.gz) touch "$arg";; esac; '
+        "done\n"
+    ),
+)
+
+
+@pytest.fixture
+def failing_mrtrix(tmp_path_factory, monkeypatch):
+    bin_dir = tmp_path_factory.mktemp("bin")
+    for name, script in FAILING_MRTRIX.items():
+        (bin_dir / name).write_text(script)
+        (bin_dir / name).chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+
+
+def test_failed_fit_is_left_out(qsiprep_dir, failing_mrtrix):
+    estimation = TensorEstimation(qsiprep_dir)
+    with pytest.warns(UserWarning, match="exit code 3"):
+        outputs = estimation.run_single_subject(
+            "01", tensor_type="diffusion_tensor"
+        )
+    assert outputs == {"1": {"diffusion_tensor": []}}
+    assert not list(qsiprep_dir.rglob("*_dwiref.nii.gz"))